@@ -0,0 +1,240 @@
+import argparse
+import contextlib
+import io
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import vc
+
+
+parser = argparse.ArgumentParser(description="Benchmark vc.py commands on a generated repository.",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+parser.add_argument("--files", metavar="N", type=int, default=1000, help="number of files in the repository")
+parser.add_argument("--depth", metavar="N", type=int, default=3, help="depth of the folder tree")
+parser.add_argument("--fanout", metavar="N", type=int, default=8, help="subfolders per folder")
+parser.add_argument("--size", metavar="BYTES", type=int, default=4096, help="approximate size of each file")
+parser.add_argument("--revisions", metavar="N", type=int, default=5, help="revisions committed per file")
+parser.add_argument("--sample", metavar="N", type=int, default=100, help="files used for single-file operations")
+parser.add_argument("--committers", metavar="N", type=int, default=4, help="parallel processes for the concurrent commit test")
+parser.add_argument("--dir", metavar="PATH", type=str, default=None, help="where to create the repository (default: a temp folder)")
+parser.add_argument("--seed", type=int, default=0, help="random seed for the generated content")
+
+
+words = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore".split()
+
+
+def io_counters():
+    # read/write syscalls and bytes written by this process, where the platform reports them
+    try:
+        with open("/proc/self/io", "r") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+
+        return int(fields["syscr"]) + int(fields["syscw"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def measure(results, name, count, fn):
+    syscalls_before, written_before = io_counters()
+    start_time = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        fn()
+
+    elapsed = time.perf_counter() - start_time
+    syscalls_after, written_after = io_counters()
+    if syscalls_before is None:
+        results.append((name, count, elapsed, None, None))
+    else:
+        results.append((name, count, elapsed, (syscalls_after - syscalls_before) / count, (written_after - written_before) / count))
+
+
+def file_path(i, depth, fanout):
+    folders = [f"d{(i // fanout ** level) % fanout}" for level in range(depth)]
+    return os.path.join(*folders, f"f{i}.txt")
+
+
+def random_text(rng, size):
+    lines = []
+    total = 0
+    while total < size:
+        line = " ".join(rng.choice(words) for _ in range(rng.randint(3, 12))) + "\n"
+        lines.append(line)
+        total += len(line)
+
+    return lines
+
+
+def edit(rng, file):
+    with open(file, "r") as f:
+        lines = f.readlines()
+
+    for _ in range(max(1, len(lines) // 20)):
+        lines[rng.randrange(len(lines))] = " ".join(rng.choice(words) for _ in range(rng.randint(3, 12))) + "\n"
+
+    with open(file, "w") as f:
+        f.writelines(lines)
+
+
+def revise(repo, files, rng, message):
+    for file in files:
+        vc.lock(repo, file)
+        edit(rng, file)
+
+    vc.commit(repo, files, message)
+
+
+def committer(repo, working_copy, files, rounds, seed):
+    os.chdir(working_copy)
+    rng = random.Random(seed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(rounds):
+            for file in files:
+                revise(repo, [file], rng, f"parallel {i}")
+
+    return len(files) * rounds
+
+
+def parallel_commits(repo, working_copy, files, num_processes, rounds):
+    chunks = [files[i::num_processes] for i in range(num_processes)]
+    start_time = time.perf_counter()
+    with ProcessPoolExecutor(num_processes) as pool:
+        num_commits = sum(pool.map(committer, [repo] * num_processes, [working_copy] * num_processes, chunks,
+                                   [rounds] * num_processes, range(num_processes)))
+
+    return num_commits / (time.perf_counter() - start_time)
+
+
+def check_commits(repo, files, expected_lengths):
+    # every commit of the parallel runs must be in the log, and the manifest must agree with it
+    failures = []
+    manifest = vc.load_manifest(repo)
+    for file in files:
+        path = vc.repo_path_of(file)
+        length = vc.log_length(os.path.join(repo, *path.split("/")))
+        entry = manifest.get(path)
+        if length != expected_lengths[file]:
+            failures.append(f"{path}: {length} log records, expected {expected_lengths[file]}")
+        elif entry is None or entry.latest != length - 1 or entry.locked:
+            failures.append(f"{path}: manifest entry {entry} does not match {length} log records")
+
+    return failures
+
+
+def check_no_global_lock(repo, working_copy, locked_file, other_file, timeout=30):
+    # while one file is locked, a commit of another file must still complete
+    held = vc.lock_paths(repo, [vc.repo_path_of(locked_file)])
+    try:
+        process = multiprocessing.Process(target=committer, args=(repo, working_copy, [other_file], 1, 0))
+        process.start()
+        process.join(timeout)
+        if process.is_alive():
+            process.terminate()
+            process.join()
+            return [f"commit of {other_file} did not complete in {timeout} s while {locked_file} was locked"]
+
+        if process.exitcode != 0:
+            return [f"commit of {other_file} failed while {locked_file} was locked"]
+    finally:
+        vc.unlock_paths(held)
+
+    return []
+
+
+def print_results(results):
+    print(f"{'Operation':<34}{'Count':>8}{'Total, s':>10}{'Ops/s':>10}{'Syscalls/op':>13}{'Written/op':>12}")
+    for name, count, elapsed, syscalls, written in results:
+        line = f"{name:<34}{count:>8}{elapsed:>10.3f}{count / max(elapsed, 1e-9):>10.0f}"
+        if syscalls is not None:
+            line += f"{syscalls:>13.1f}{written:>12.0f}"
+
+        print(line)
+
+
+def main():
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    base = args.dir or tempfile.mkdtemp(prefix="vc_bench_")
+    repo = os.path.abspath(os.path.join(base, "repo"))
+    working_copy = os.path.join(base, "wc")
+    files = [file_path(i, args.depth, args.fanout) for i in range(args.files)]
+    sample = rng.sample(files, min(args.sample, len(files)))
+    initial_dir = os.getcwd()
+    failures = ["the benchmark did not complete"]
+    print(f"{args.files} files, depth {args.depth}, ~{args.size} bytes each, {args.revisions} revisions per file in {base}")
+    try:
+        os.makedirs(working_copy)
+        os.chdir(working_copy)
+        for file in files:
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+            with open(file, "w") as f:
+                f.writelines(random_text(rng, args.size))
+
+        results = []
+        measure(results, "create", 1, lambda: vc.create(repo))
+        measure(results, "commit (add, one batch)", len(files), lambda: vc.commit(repo, ["."], "initial"))
+        for revision in range(1, args.revisions):
+            measure(results, f"lock (rev. {revision})", len(files), lambda: [vc.lock(repo, file) for file in files])
+            for file in files:
+                edit(rng, file)
+
+            measure(results, f"commit (rev. {revision}, one batch)", len(files), lambda: vc.commit(repo, files, f"revision {revision}"))
+
+        measure(results, "commit (single file)", len(sample), lambda: [revise(repo, [file], rng, "single") for file in sample])
+        measure(results, "status (unchanged)", len(files), lambda: vc.status(repo, "."))
+        os.chdir(initial_dir)
+        os.makedirs(os.path.join(base, "wc2"))
+        os.chdir(os.path.join(base, "wc2"))
+        measure(results, "checkout (tree, fresh)", len(files), lambda: vc.checkout(repo))
+        measure(results, "checkout (tree, up to date)", len(files), lambda: vc.checkout(repo))
+        shutil.rmtree(os.path.join(base, "wc2"))
+        os.makedirs(os.path.join(base, "wc2"))
+        os.chdir(os.path.join(base, "wc2"))
+        measure(results, "checkout (tree, fresh, --link)", len(files), lambda: vc.checkout(repo, link=True))
+        os.chdir(working_copy)
+
+        def checkout_old_versions():
+            for file in sample:
+                vc.make_writable(file)
+                os.remove(file)
+                vc.checkout(repo, file, 0)
+
+        measure(results, "checkout (version 0)", len(sample), checkout_old_versions)
+        measure(results, "log", len(sample), lambda: [vc.log(repo, file) for file in sample])
+        measure(results, "pack", 1, lambda: vc.pack(repo))
+        measure(results, "checkout (version 0, packed)", len(sample), checkout_old_versions)
+        measure(results, "gc", 1, lambda: vc.gc(repo))
+        print_results(results)
+
+        rounds = 3
+        expected_lengths = {file: vc.log_length(os.path.join(repo, *vc.repo_path_of(file).split("/"))) + 2 * rounds for file in sample}
+        single = parallel_commits(repo, working_copy, sample, 1, rounds)
+        parallel = parallel_commits(repo, working_copy, sample, args.committers, rounds)
+        print(f"Concurrent commits on different files: {single:.0f} commits/s with 1 process, "
+              f"{parallel:.0f} commits/s with {args.committers} processes ({parallel / single:.2f}x)")
+        failures = check_commits(repo, sample, expected_lengths)
+        if len(sample) >= 2:
+            failures += check_no_global_lock(repo, working_copy, sample[0], sample[1])
+
+        for failure in failures:
+            print(f"FAILED: {failure}")
+
+        if not failures:
+            print(f"All {len(sample) * 2 * rounds} concurrent commits are in the logs and the manifest, "
+                  "and a commit completes while another file is locked")
+    finally:
+        os.chdir(initial_dir)
+        if args.dir is None:
+            shutil.rmtree(base, ignore_errors=True)
+
+    if failures:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,16 @@ import time
 import shutil
 import stat
 import pathlib
+import struct
+import zlib
+import json
+import hashlib
+import fcntl
+import mmap
+import getpass
+import socket
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 
 usage = """Simple(c) version control system. Usage:
@@ -13,18 +23,54 @@ python vc.py commit <repo> <file> <message> [num_revisions_to_keep] .   . Commit
                                                                           If the file doesn't exist, it will be deleted from repo.
                                                                           File will be unlocked. Optionally, the max number of
                                                                           revisions to keep in the repo can be set.
+                                                                          File names starting with ".vc-" are reserved.
+python vc.py commit <repo> -m <message> [-k num_revisions_to_keep] <path>...  Commit many files at once. All of them are committed or none.
+                                                                          A path can be a file, a folder (new and locked files in it)
+                                                                          or "-" to read file paths from stdin, one per line.
 python vc.py lock <repo> <file>     .   .   .   .   .   .   .   .   .   . Lock the file to enable changes.
-python vc.py checkout <repo> [file [version_number]]    .   .   .   .   . Retrieve latest revisions of all files.
+python vc.py checkout <repo> [file [version_number]] [--link]   .   .   . Retrieve latest revisions of all files.
                                                                           If a file is specified, checkout only that file.
                                                                           If a version number is specified, checkout this version.
-python vc.py log <repo> <file>      .   .   .   .   .   .   .   .   .   . Print version log of the file."""
+                                                                          With --link, files are reflinked or hardlinked from the
+                                                                          repository where possible instead of copied.
+python vc.py log <repo> <file> [num_entries]   .   .   .   .   .   .   . Print version log of the file, optionally only the latest entries.
+python vc.py pack <repo>    .   .   .   .   .   .   .   .   .   .   .   . Move old revisions of all files into a single pack file.
+python vc.py gc <repo> [--background] .   .   .   .   .   .   .   .   . Reclaim space taken by expired revisions in pack files.
+python vc.py migrate <repo> .   .   .   .   .   .   .   .   .   .   .   . Convert text logs of an old repository to the binary format.
+python vc.py status <repo>  .   .   .   .   .   .   .   .   .   .   .   . List modified, locked, missing and out of date files in the
+                                                                          working copy (current folder).
+python vc.py stats <repo>   .   .   .   .   .   .   .   .   .   .   .   . Print storage statistics: bytes saved by reverse deltas."""
+
+checkout_threads = 16  # whole-tree checkout is I/O latency bound, so use more threads than cores
+FICLONE = 0x40049409  # Linux ioctl for copy-on-write file clones (btrfs, xfs)
+snapshot_interval = 8  # every n-th revision is kept in full to bound the delta chain length
+reserved_prefix = ".vc-"
+manifest_name = ".vc-manifest"
+manifest_magic = b"VCM1"
+status_cache_name = ".vc-status"
+staging_name = ".vc-staging"
+packs_name = ".vc-packs"
+locks_name = ".vc-locks"
+pack_loose_revisions = 2  # the newest revisions of each file stay as loose files
+pack_magic = b"VCP1"
+pack_index_magic = b"VCX1"
+pack_entry_header = struct.Struct(">HQBQ")  # path length, version, kind, blob length; followed by path and blob
+pack_index_record = struct.Struct(">16sQQQB7x")  # path digest, version, blob offset, blob length, kind. Sorted
+pack_kind_full = 0
+pack_kind_delta = 1
+manifest_record = struct.Struct("<iiBBq")  # latest version, oldest kept version, locked, deleted, tip timestamp
+
+log_record = struct.Struct("<qqqII")  # timestamp, revision size (-1: deleted, -2: unknown), message offset, message length, reserved
+
+ManifestEntry = namedtuple("ManifestEntry", "latest oldest locked deleted tip_time")
+open_packs = {}  # index path -> (index mmap, pack mmap)
 
 
 class UsageError(Exception):
     pass
 
 
-def load_log(file_repo_path):
+def load_text_log(file_repo_path):
     try:
         with open(os.path.join(file_repo_path, "log"), "r") as f:
             versions = []
@@ -39,6 +85,64 @@ def load_log(file_repo_path):
         raise RuntimeError("Repository is broken")
 
 
+def log_length(file_repo_path):
+    # fixed-size records: the number of versions is known from the file size alone
+    try:
+        return os.stat(os.path.join(file_repo_path, "log.bin")).st_size // log_record.size
+    except FileNotFoundError:
+        return len(load_text_log(file_repo_path))
+
+
+def read_log(file_repo_path, first=0, last=None):
+    # (message, timestamp) of versions first..last-1, reading only those records
+    try:
+        f = open(os.path.join(file_repo_path, "log.bin"), "rb")
+    except FileNotFoundError:
+        return load_text_log(file_repo_path)[first:last]
+
+    try:
+        with f, open(os.path.join(file_repo_path, "messages"), "rb") as messages_file:
+            count = os.fstat(f.fileno()).st_size // log_record.size
+            last = count if last is None else min(last, count)
+            f.seek(first * log_record.size)
+            versions = []
+            for timestamp, _, message_offset, message_len, _ in log_record.iter_unpack(f.read((last - first) * log_record.size)):
+                messages_file.seek(message_offset)
+                versions.append([messages_file.read(message_len).decode("utf8"), timestamp])
+
+            return versions
+    except Exception:
+        raise RuntimeError("Repository is broken")
+
+
+def migrate_log(file_repo_path):
+    # convert a text log into log.bin + messages. log.bin is published with a rename, so readers never see a partial log.
+    # The caller holds the lock of the file, so no commit appends to the log meanwhile
+    text_log = os.path.join(file_repo_path, "log")
+    if not os.path.exists(text_log):
+        return False
+
+    if not os.path.exists(os.path.join(file_repo_path, "log.bin")):
+        messages = bytearray()
+        records = bytearray()
+        for version, (message, timestamp) in enumerate(load_text_log(file_repo_path)):
+            message_bytes = message.encode("utf8")
+            records += log_record.pack(timestamp, revision_size(file_repo_path, version), len(messages), len(message_bytes), 0)
+            messages += message_bytes
+
+        with open(os.path.join(file_repo_path, "messages"), "wb") as f:
+            f.write(messages)
+
+        tmp_path = os.path.join(file_repo_path, f"log.bin.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(records)
+
+        os.replace(tmp_path, os.path.join(file_repo_path, "log.bin"))
+
+    os.remove(text_log)
+    return True
+
+
 def make_readonly(filename):
     mode = os.stat(filename).st_mode
     ro_mask = 0o777 ^ (stat.S_IWRITE | stat.S_IWGRP | stat.S_IWOTH)
@@ -50,203 +154,1230 @@ def make_writable(file):
     os.chmod(file, mode | stat.S_IWRITE)
 
 
-def checkout(file_repo_path, file, need_version):
-    versions = load_log(file_repo_path)
-    latest_version = len(versions) - 1
-    if need_version is None:
-        need_version = latest_version
+def version_file(file_repo_path, version):
+    return os.path.join(file_repo_path, str(version))
 
-    assert need_version <= latest_version, f"wrong version requested. Latest version: {latest_version}"
-    ver_file = os.path.join(file_repo_path, str(need_version))
-    ver_time = versions[need_version][1]
-    if not os.path.exists(file):
-        if not os.path.exists(ver_file):
-            print(f"[{file}] v. {need_version} is deleted from repository and does not exist in working copy")
+
+def delta_file(file_repo_path, version):
+    return os.path.join(file_repo_path, f"{version}.delta")
+
+
+def version_exists(file_repo_path, version, packed=None):
+    return os.path.exists(version_file(file_repo_path, version)) or os.path.exists(delta_file(file_repo_path, version)) or \
+        bool(packed) and version in packed
+
+
+def make_delta(base: bytes, target: bytes):
+    # line-based delta: instructions to rebuild target from base.
+    # b"C" + offset + length copies a range of base, b"I" + length + data inserts literal bytes
+    base_lines = base.splitlines(keepends=True)
+    line_offsets = [0]
+    first_line = {}
+    for i, line in enumerate(base_lines):
+        first_line.setdefault(line, i)
+        line_offsets.append(line_offsets[-1] + len(line))
+
+    ops = bytearray()
+    literal = bytearray()
+    copy_from = copy_to = None
+
+    def flush_copy():
+        if copy_from is None:
+            return
+
+        start, end = line_offsets[copy_from], line_offsets[copy_to]
+        if end - start <= 17:
+            literal.extend(base[start:end])
+            return
+
+        flush_literal()
+        ops.extend(b"C" + struct.pack("<QQ", start, end - start))
+
+    def flush_literal():
+        if literal:
+            ops.extend(b"I" + struct.pack("<Q", len(literal)) + literal)
+            literal.clear()
+
+    for line in target.splitlines(keepends=True):
+        if copy_to is not None and copy_to < len(base_lines) and base_lines[copy_to] == line:
+            copy_to += 1
+            continue
+
+        flush_copy()
+        copy_from = first_line.get(line)
+        if copy_from is None:
+            copy_to = None
+            literal.extend(line)
+        else:
+            copy_to = copy_from + 1
+
+    flush_copy()
+    flush_literal()
+    return bytes(ops)
+
+
+def apply_delta(base: bytes, delta: bytes):
+    result = bytearray()
+    pos = 0
+    while pos < len(delta):
+        op = delta[pos:pos + 1]
+        if op == b"C":
+            start, length = struct.unpack_from("<QQ", delta, pos + 1)
+            result.extend(base[start:start + length])
+            pos += 17
+        elif op == b"I":
+            length, = struct.unpack_from("<Q", delta, pos + 1)
+            result.extend(delta[pos + 9:pos + 9 + length])
+            pos += 9 + length
+        else:
+            raise RuntimeError("Repository is broken")
+
+    return bytes(result)
+
+
+def parse_delta(raw):
+    size, = struct.unpack_from("<Q", raw)
+    return size, zlib.decompress(raw[8:])
+
+
+def read_delta(delta_path):
+    with open(delta_path, "rb") as f:
+        return parse_delta(f.read())
+
+
+def write_reverse_delta(old_path, new_path, delta_path):
+    # compressed delta that rebuilds the old version from the next one. Not written if it would not save space
+    with open(old_path, "rb") as f:
+        old = f.read()
+
+    with open(new_path, "rb") as f:
+        new = f.read()
+
+    packed = zlib.compress(make_delta(new, old))
+    if 8 + len(packed) >= len(old):
+        return 0
+
+    with open(delta_path, "wb") as f:
+        f.write(struct.pack("<Q", len(old)))
+        f.write(packed)
+
+    return len(old) - 8 - len(packed)
+
+
+def read_keep(file_repo_path):
+    # number of revisions to keep and the oldest version still kept (None in repositories that did not track it)
+    with open(os.path.join(file_repo_path, "keep"), "r") as f:
+        fields = f.read().split()
+
+    return int(fields[0]), int(fields[1]) if len(fields) > 1 else None
+
+
+def load_packs(repo_folder):
+    packs_path = os.path.join(repo_folder, packs_name)
+    try:
+        names = sorted(os.listdir(packs_path), reverse=True)
+    except FileNotFoundError:
+        return []
+
+    packs = []
+    for name in names:
+        if not name.endswith(".idx"):
+            continue
+
+        idx_path = os.path.join(packs_path, name)
+        if idx_path not in open_packs:
+            try:
+                with open(idx_path, "rb") as idx_file, open(idx_path[:-4] + ".pack", "rb") as pack_file:
+                    open_packs[idx_path] = (mmap.mmap(idx_file.fileno(), 0, access=mmap.ACCESS_READ),
+                                            mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ))
+            except FileNotFoundError:
+                # removed by gc after it wrote the compacted pack: list again to pick that one up
+                return load_packs(repo_folder)
+
+        packs.append(open_packs[idx_path])
+
+    return packs
+
+
+def path_digest(path):
+    return hashlib.blake2b(path.encode("utf8"), digest_size=16).digest()
+
+
+def packed_revisions(repo_folder, path, oldest=0):
+    # {version: (kind, pack, offset, length)} of the packed revisions of a file, found by binary search in each index
+    digest = path_digest(path)
+    first_key = digest + bytes(8)
+    revisions = {}
+    for idx, pack in load_packs(repo_folder):
+        count = (len(idx) - len(pack_index_magic)) // pack_index_record.size
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            record_pos = len(pack_index_magic) + mid * pack_index_record.size
+            if idx[record_pos:record_pos + 24] < first_key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        for i in range(lo, count):
+            record_digest, version, offset, length, kind = pack_index_record.unpack_from(idx, len(pack_index_magic) + i * pack_index_record.size)
+            if record_digest != digest:
+                break
+
+            if version >= oldest:
+                revisions.setdefault(version, (kind, pack, offset, length))
+
+    return revisions
+
+
+def file_packed_revisions(repo_folder, path):
+    if not load_packs(repo_folder):
+        return {}
+
+    return packed_revisions(repo_folder, path, read_keep(os.path.join(repo_folder, *path.split("/")))[1] or 0)
+
+
+def revision_size(file_repo_path, version):
+    try:
+        return os.path.getsize(version_file(file_repo_path, version))
+    except FileNotFoundError:
+        pass
+
+    try:
+        return read_delta(delta_file(file_repo_path, version))[0]
+    except FileNotFoundError:
+        return -2
+
+
+def read_revision(file_repo_path, version, packed):
+    # loose files first, then packs: (is_full, content)
+    try:
+        with open(version_file(file_repo_path, version), "rb") as f:
+            return True, f.read()
+    except FileNotFoundError:
+        pass
+
+    try:
+        with open(delta_file(file_repo_path, version), "rb") as f:
+            return False, f.read()
+    except FileNotFoundError:
+        pass
+
+    if packed and version in packed:
+        kind, pack, offset, length = packed[version]
+        return kind == pack_kind_full, pack[offset:offset + length]
+
+    raise RuntimeError("Repository is broken")
+
+
+def read_version(file_repo_path, version, packed=None):
+    # walk up the reverse delta chain to the nearest full revision, then apply the deltas back down
+    chain = []
+    is_full, data = read_revision(file_repo_path, version, packed)
+    while not is_full:
+        chain.append(parse_delta(data))
+        version += 1
+        is_full, data = read_revision(file_repo_path, version, packed)
+
+    for size, delta in reversed(chain):
+        data = apply_delta(data, delta)
+        if len(data) != size:
+            raise RuntimeError("Repository is broken")
+
+    return data
+
+
+def place_file(src, dst):
+    # working copies are read-only until locked, so they can share storage with the revision: try a reflink
+    # (copy-on-write clone), then a hardlink, then an in-kernel copy. lock breaks hardlinks (see break_link)
+    with open(src, "rb") as fsrc:
+        with open(dst, "wb") as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return "reflinked"
+            except OSError:
+                pass
+
+        os.remove(dst)
+        try:
+            os.link(src, dst)
+            return "linked"
+        except OSError:
+            pass
+
+        with open(dst, "wb") as fdst:
+            size = os.fstat(fsrc.fileno()).st_size
+            copied = 0
+            try:
+                while copied < size:
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+                    if n == 0:
+                        break
+
+                    copied += n
+            except (AttributeError, OSError):
+                fdst.seek(0)
+                fdst.truncate()
+                copied = 0
+                try:
+                    while copied < size:
+                        n = os.sendfile(fdst.fileno(), fsrc.fileno(), copied, size - copied)
+                        if n == 0:
+                            break
+
+                        copied += n
+                except OSError:
+                    fdst.seek(0)
+                    fdst.truncate()
+                    fsrc.seek(0)
+                    shutil.copyfileobj(fsrc, fdst)
+
+    shutil.copymode(src, dst)
+    return "copied"
+
+
+def break_link(file):
+    # a hardlinked working copy shares its inode with a revision in the repository: copy it before allowing writes
+    if os.stat(file).st_nlink > 1:
+        tmp_path = f"{file}.{os.getpid()}.tmp"
+        shutil.copy2(file, tmp_path)
+        os.replace(tmp_path, file)
+
+
+def copy_version(file_repo_path, version, file, link=False, packed=None):
+    ver_file = version_file(file_repo_path, version)
+    if os.path.exists(ver_file):
+        if link:
+            place_file(ver_file, file)
         else:
             shutil.copy(ver_file, file)
+    else:
+        with open(file, "wb") as f:
+            f.write(read_version(file_repo_path, version, packed))
+
+
+def repo_path_of(file):
+    return pathlib.PurePath(os.path.normpath(file)).as_posix()
+
+
+def manifest_path(repo_folder):
+    return os.path.join(repo_folder, manifest_name)
+
+
+def encode_manifest_record(path, entry):
+    path_bytes = path.encode("utf8")
+    return struct.pack("<H", len(path_bytes)) + path_bytes + manifest_record.pack(*entry)
+
+
+def loose_revisions(file_repo_path):
+    return {int(name.split(".")[0]) for name in os.listdir(file_repo_path) if name.split(".")[0].isdigit()}
+
+
+def scan_entry(repo_folder, path):
+    file_repo_path = os.path.join(repo_folder, *path.split("/"))
+    latest = log_length(file_repo_path) - 1
+    oldest = read_keep(file_repo_path)[1]
+    if oldest is None:
+        oldest = min(loose_revisions(file_repo_path) | set(packed_revisions(repo_folder, path)), default=latest + 1)
+
+    return ManifestEntry(latest, oldest, os.path.exists(os.path.join(file_repo_path, "lock")),
+                         not version_exists(file_repo_path, latest), read_log(file_repo_path, latest, latest + 1)[0][1])
+
+
+def tracked_files(repo_folder, path=""):
+    repo_subs = all_subfolders(repo_folder)
+    if not repo_subs and path:
+        yield path, repo_folder
+
+    for repo_sub in repo_subs:
+        name = os.path.basename(repo_sub)
+        if not path and name.startswith(reserved_prefix):
+            continue
+
+        yield from tracked_files(repo_sub, f"{path}/{name}" if path else name)
+
+
+def write_manifest(repo_folder, entries):
+    tmp_path = f"{manifest_path(repo_folder)}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(manifest_magic)
+        f.write(b"".join(encode_manifest_record(path, entry) for path, entry in sorted(entries.items())))
+
+    os.replace(tmp_path, manifest_path(repo_folder))
+
+
+def lock_manifest(repo_folder, mode):
+    # appends share the lock, rewrites take it exclusively so that no append is lost
+    fd = os.open(manifest_path(repo_folder) + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+    fcntl.flock(fd, mode)
+    return fd
+
+
+def compact_manifest(repo_folder):
+    fd = lock_manifest(repo_folder, fcntl.LOCK_EX)
+    try:
+        entries, _ = read_manifest(repo_folder)
+        write_manifest(repo_folder, entries)
+        return entries
+    finally:
+        os.close(fd)
+
+
+def read_manifest(repo_folder):
+    try:
+        with open(manifest_path(repo_folder), "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        entries = {path: scan_entry(repo_folder, path) for path, _ in tracked_files(repo_folder)}
+        write_manifest(repo_folder, entries)
+        return entries, len(entries)
+
+    if data[:len(manifest_magic)] != manifest_magic:
+        raise RuntimeError("Repository is broken")
+
+    entries = {}
+    num_records = 0
+    pos = len(manifest_magic)
+    while pos + 2 <= len(data):
+        path_len, = struct.unpack_from("<H", data, pos)
+        record_pos = pos + 2 + path_len
+        if record_pos + manifest_record.size > len(data):
+            break  # torn append, the operation that wrote it did not complete
+
+        entries[data[pos + 2:record_pos].decode("utf8")] = ManifestEntry(*manifest_record.unpack_from(data, record_pos))
+        pos = record_pos + manifest_record.size
+        num_records += 1
+
+    return entries, num_records
+
+
+def load_manifest(repo_folder):
+    # the manifest is a snapshot followed by appended records; the last record for a path wins
+    if not os.path.exists(manifest_path(repo_folder)):
+        return compact_manifest(repo_folder)
+
+    entries, num_records = read_manifest(repo_folder)
+    if num_records > 2 * len(entries) + 64:
+        entries = compact_manifest(repo_folder)
+
+    return entries
+
+
+def update_manifest(repo_folder, path, entry):
+    # a single append is atomic: readers see either the old or the new record
+    lock_fd = lock_manifest(repo_folder, fcntl.LOCK_SH)
+    try:
+        fd = os.open(manifest_path(repo_folder), os.O_WRONLY | os.O_APPEND)
+    except FileNotFoundError:
+        os.close(lock_fd)
+        load_manifest(repo_folder)
+        return
+
+    try:
+        os.write(fd, encode_manifest_record(path, entry))
+    finally:
+        os.close(fd)
+        os.close(lock_fd)
+
+
+def checkout_file(file_repo_path, file, need_version, entry=None, link=False, packed=None):
+    lock_file = os.path.join(file_repo_path, "lock")
+    if entry is not None and need_version is None:
+        need_version, ver_time, ver_exists = entry.latest, entry.tip_time, not entry.deleted
+        is_locked = lambda: entry.locked
+    else:
+        latest_version = log_length(file_repo_path) - 1
+        if need_version is None:
+            need_version = latest_version
+
+        assert need_version <= latest_version, f"wrong version requested. Latest version: {latest_version}"
+        ver_time = read_log(file_repo_path, need_version, need_version + 1)[0][1]
+        ver_exists = version_exists(file_repo_path, need_version, packed)
+        is_locked = lambda: os.path.exists(lock_file)
+
+    if not os.path.exists(file):
+        if not ver_exists:
+            return f"[{file}] v. {need_version} is deleted from repository and does not exist in working copy"
+        else:
+            copy_version(file_repo_path, need_version, file, link, packed)
             os.utime(file, (ver_time, ver_time))
             make_readonly(file)
-            print(f"[{file}] v. {need_version} is checked out")
+            return f"[{file}] v. {need_version} is checked out"
     else:
         mode = os.stat(file).st_mode
-        if (mode & stat.S_IWRITE) and os.path.exists(os.path.join(file_repo_path, "lock")):
-            print(f"[{file}] is locked. Skipping checkout")
-            return
+        if (mode & stat.S_IWRITE) and is_locked():
+            return f"[{file}] is locked. Skipping checkout"
 
-        if not os.path.exists(ver_file):
-            print(f"[{file}] v. {need_version} is deleted from repository; deleting it from working copy")
+        if not ver_exists:
             make_writable(file)
             os.remove(file)
+            return f"[{file}] v. {need_version} is deleted from repository; deleting it from working copy"
         else:
             mod_time = os.path.getmtime(file)
             if mod_time == ver_time:
-                print(f"[{file}] v. {need_version} is up to date")
+                return f"[{file}] v. {need_version} is up to date"
             else:
                 make_writable(file)
                 os.remove(file)                
-                shutil.copy(ver_file, file)
+                copy_version(file_repo_path, need_version, file, link, packed)
                 os.utime(file, (ver_time, ver_time))
                 make_readonly(file)
-                print(f"[{file}] v. {need_version} is checked out")
+                return f"[{file}] v. {need_version} is checked out"
 
 
 def all_subfolders(folder):
-    return [f.path for f in os.scandir(folder) if f.is_dir()]
+    return sorted(f.path for f in os.scandir(folder) if f.is_dir())
 
 
-def checkout_recursive(repo_folder, working_copy_path):
-    repo_subs = all_subfolders(repo_folder)
-    if not repo_subs:
-        checkout(repo_folder, working_copy_path, None)
+def checkout_tree(repo_folder, working_copy_path, link=False):
+    plan = []
+    known_folders = set()
+    for path, entry in sorted(load_manifest(repo_folder).items()):
+        file = os.path.join(working_copy_path, *path.split("/"))
+        folder = os.path.dirname(file)
+        if folder not in known_folders:
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            else:
+                assert os.path.isdir(folder), f"[{folder}] is a folder in repository, but something else in working copy"
+
+            known_folders.add(folder)
+
+        plan.append((os.path.join(repo_folder, *path.split("/")), file, entry))
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(checkout_threads) as pool:
+        for message in pool.map(lambda job: checkout_file(job[0], job[1], None, job[2], link), plan):
+            print(message)
+
+    elapsed = time.perf_counter() - start_time
+    print(f"Checked out {len(plan)} files in {elapsed:.2f} s ({len(plan) / max(elapsed, 1e-9):.0f} files/s)")
+
+
+def file_hash(filename):
+    h = hashlib.blake2b(digest_size=20)
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+def status(repo_folder, working_copy_path):
+    # compare the working copy against the manifest. Cached (size, mtime, inode) snapshots let unchanged files
+    # skip hashing; the hash of a tip revision is cached by version number, since revisions are immutable
+    cache_file = os.path.join(working_copy_path, status_cache_name)
+    try:
+        with open(cache_file, "r") as f:
+            cache = json.load(f)
+    except (FileNotFoundError, ValueError):
+        cache = {}
+
+    new_cache = {}
+    report = []
+    num_hashed = 0
+    for path, entry in sorted(load_manifest(repo_folder).items()):
+        file = os.path.join(working_copy_path, *path.split("/"))
+        try:
+            st = os.stat(file)
+        except FileNotFoundError:
+            if not entry.deleted:
+                report.append(f"[{file}] is missing")
+
+            continue
+
+        if entry.deleted:
+            report.append(f"[{file}] is deleted from repository")
+            continue
+
+        snapshot = [st.st_size, st.st_mtime_ns, st.st_ino]
+        cached = cache.get(path)
+        if cached is not None and cached[:3] == snapshot:
+            file_digest = cached[3]
+        else:
+            file_digest = file_hash(file)
+            num_hashed += 1
+
+        if cached is not None and cached[4] == entry.latest:
+            tip_digest = cached[5]
+        else:
+            tip_digest = file_hash(version_file(os.path.join(repo_folder, *path.split("/")), entry.latest))
+            num_hashed += 1
+
+        new_cache[path] = snapshot + [file_digest, entry.latest, tip_digest]
+        if entry.locked:
+            report.append(f"[{file}] is locked and modified" if file_digest != tip_digest else f"[{file}] is locked")
+        elif file_digest != tip_digest:
+            report.append(f"[{file}] is out of date")
+
+    if new_cache != cache:
+        tmp_path = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(new_cache, f)
+
+        os.replace(tmp_path, cache_file)
+
+    return report, len(new_cache), num_hashed
+
+
+def lock_paths(repo_folder, paths, blocking=True):
+    # per-file advisory locks, so committers of different files never wait for each other. Files are always
+    # locked in the same order, so overlapping batches cannot deadlock
+    locks_path = os.path.join(repo_folder, locks_name)
+    os.makedirs(locks_path, exist_ok=True)
+    held = {}
+    try:
+        for digest, path in sorted((path_digest(path).hex(), path) for path in set(paths)):
+            fd = os.open(os.path.join(locks_path, digest), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BaseException:
+                os.close(fd)
+                raise
+
+            held[path] = fd
+    except BaseException:
+        unlock_paths(held)
+        raise
+
+    return held
+
+
+def unlock_paths(held):
+    for fd in held.values():
+        os.close(fd)
+
+
+def transaction_alive(tx_name):
+    # called with the transaction folder locked: the owner may still be between creating and locking it
+    try:
+        os.kill(int(tx_name.split("-")[0]), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def apply_journal(repo_folder, tx_path):
+    # replaying a journal is idempotent, so an interrupted apply can simply be repeated
+    with open(os.path.join(tx_path, "journal"), "r") as f:
+        ops = json.load(f)
+
+    for op, *op_args in ops:
+        if op == "mkdir":
+            os.makedirs(os.path.join(repo_folder, op_args[0]), exist_ok=True)
+        elif op == "move":
+            staged = os.path.join(tx_path, op_args[0])
+            if os.path.exists(staged):
+                os.replace(staged, os.path.join(repo_folder, op_args[1]))
+        elif op == "remove":
+            try:
+                os.remove(os.path.join(repo_folder, op_args[0]))
+            except FileNotFoundError:
+                pass
+        elif op == "pwrite":
+            fd = os.open(os.path.join(repo_folder, op_args[0]), os.O_WRONLY | os.O_CREAT, 0o644)
+            try:
+                os.pwrite(fd, bytes.fromhex(op_args[2]), op_args[1])
+            finally:
+                os.close(fd)
+        elif op == "manifest":
+            update_manifest(repo_folder, op_args[0], ManifestEntry(*op_args[1]))
+
+    shutil.rmtree(tx_path)
+
+
+def recover_transactions(repo_folder, held=None):
+    # roll forward published transactions and roll back unpublished ones left behind by crashed processes.
+    # A running transaction keeps its folder locked. Files of the caller are already locked in held
+    held = held or {}
+    staging_path = os.path.join(repo_folder, staging_name)
+    if not os.path.exists(staging_path):
         return
 
-    if not os.path.exists(working_copy_path):
-        os.makedirs(working_copy_path)
+    for tx in os.scandir(staging_path):
+        try:
+            tx_fd = os.open(tx.path, os.O_RDONLY)
+        except FileNotFoundError:
+            continue
+
+        try:
+            try:
+                fcntl.flock(tx_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+
+            if transaction_alive(tx.name):
+                continue
+
+            if not os.path.exists(os.path.join(tx.path, "journal")):
+                shutil.rmtree(tx.path)
+                continue
+
+            with open(os.path.join(tx.path, "journal"), "r") as f:
+                paths = [op_args[0] for op, *op_args in json.load(f) if op == "manifest"]
+
+            try:
+                tx_held = lock_paths(repo_folder, [path for path in paths if path not in held], blocking=False)
+            except BlockingIOError:
+                if any(path in held for path in paths):
+                    raise RuntimeError("an interrupted commit of these files is being recovered by another process, try again")
+
+                continue
+
+            try:
+                apply_journal(repo_folder, tx.path)
+            finally:
+                unlock_paths(tx_held)
+        finally:
+            os.close(tx_fd)
+
+
+def stage_file(tx_path, ops, dest, src=None, data=None):
+    name = str(len(ops))
+    staged = os.path.join(tx_path, name)
+    if src is not None:
+        shutil.copy(src, staged)
     else:
-        assert os.path.isdir(working_copy_path), f"[{working_copy_path}] is a folder in repository, but something else in working copy"
+        with open(staged, "w") as f:
+            f.write(data)
 
-    for repo_sub in repo_subs:
-        working_copy_sub = os.path.join(working_copy_path, os.path.basename(repo_sub))
-        checkout_recursive(repo_sub, working_copy_sub)
+    ops.append(("move", name, dest))
+    return staged
 
 
-try:
-    if len(sys.argv) < 3:
-        raise UsageError()
+def stage_commit(repo_folder, tx_path, file, message, num_revisions_to_keep, commit_time, ops, messages):
+    assert not os.path.exists(file) or os.path.isfile(file), f"not a regular file: [{file}]"
+    path = repo_path_of(file)
+    assert not path.startswith(reserved_prefix), f"reserved file name: [{file}]"
+    file_repo_path = os.path.join(repo_folder, *path.split("/"))
+    lock_file = os.path.join(file_repo_path, "lock")
+    if not os.path.exists(file_repo_path):
+        if not os.path.exists(file):
+            raise RuntimeError(f"[{file}] does not exist in working copy and in repository")
 
-    command = sys.argv[1]
-    repo_folder = sys.argv[2]
-    if command == "create":
-        if len(sys.argv) != 3:
-            raise UsageError()
+        if num_revisions_to_keep == -1:
+            num_revisions_to_keep = 10
 
-        os.mkdir(repo_folder)
-        print(f"New empty repository [{repo_folder}] has been created.")
-    elif command == "commit":
-        if not (5 <= len(sys.argv) <= 6):
-            raise UsageError
+        messages.append(f"Adding {file} to the repository, keeping {num_revisions_to_keep} latest revisions")
+        ops.append(("mkdir", path))
+        version_num = 0
+        oldest = 0
+        prev_num_revisions_to_keep = num_revisions_to_keep
+        keep_has_oldest = False
+        message_offset = 0
+    else:
+        migrate_log(file_repo_path)
+        version_num = log_length(file_repo_path)
+        message_offset = os.path.getsize(os.path.join(file_repo_path, "messages"))
+        if version_exists(file_repo_path, version_num - 1) and not os.path.exists(lock_file):
+            raise RuntimeError(f"[{file}] is not locked")
 
-        assert os.path.exists(repo_folder) and os.path.isdir(repo_folder), "missing/wrong repository folder"
-        file, message = sys.argv[3:5]
-        assert not os.path.exists(file) or os.path.isfile(file), f"not a regular file: [{file}]"
-        num_revisions_to_keep = -1
-        if len(sys.argv) == 6:
-            num_revisions_to_keep = int(sys.argv[5])
-            assert num_revisions_to_keep > 0, "wrong number of revisions to keep"
+        messages.append(f"New version of [{file}]: {version_num}")
+        prev_num_revisions_to_keep, oldest = read_keep(file_repo_path)
+        keep_has_oldest = oldest is not None
+        if oldest is None:
+            oldest = min(loose_revisions(file_repo_path) | set(packed_revisions(repo_folder, path)), default=version_num)
 
-        file_repo_path = os.path.join(repo_folder, file)
-        lock_file = os.path.join(file_repo_path, "lock")
-        if not os.path.exists(file_repo_path):
-            if not os.path.exists(file):
-                raise RuntimeError(f"[{file}] does not exist in working copy and in repository")
+        if num_revisions_to_keep != -1 and prev_num_revisions_to_keep != num_revisions_to_keep:
+            messages.append(f"Changing number of revisions to keep from {prev_num_revisions_to_keep} to {num_revisions_to_keep}")
+        else:
+            num_revisions_to_keep = prev_num_revisions_to_keep
+
+    # log records are written at fixed offsets, so replaying them is idempotent
+    message_bytes = message.replace("\t", "    ").replace("\n", "  ").encode("utf8")
+    record = log_record.pack(commit_time, os.path.getsize(file) if os.path.exists(file) else -1, message_offset, len(message_bytes), 0)
+    ops.append(("pwrite", f"{path}/messages", message_offset, message_bytes.hex()))
+    ops.append(("pwrite", f"{path}/log.bin", version_num * log_record.size, record.hex()))
+
+    new_oldest = max(oldest, version_num - num_revisions_to_keep + 1)
+    if os.path.exists(file):
+        staged = stage_file(tx_path, ops, f"{path}/{version_num}", src=file)
+        prev_version = version_num - 1
+        prev_file = version_file(file_repo_path, prev_version)
+        # no delta for a previous version that expires with this commit
+        if prev_version >= new_oldest and prev_version % snapshot_interval != 0 and os.path.exists(prev_file):
+            name = str(len(ops))
+            saved = write_reverse_delta(prev_file, staged, os.path.join(tx_path, name))
+            if saved > 0:
+                ops.append(("move", name, f"{path}/{prev_version}.delta"))
+                ops.append(("remove", f"{path}/{prev_version}"))
+                messages.append(f"Stored v. {prev_version} as a reverse delta, saving {saved} bytes")
+
+    # only the versions between the old and the new oldest kept version expire. Packed ones are hidden by the new
+    # oldest version and reclaimed by gc
+    for ver_to_remove in range(new_oldest - 1, oldest - 1, -1):
+        ops.append(("remove", f"{path}/{ver_to_remove}"))
+        ops.append(("remove", f"{path}/{ver_to_remove}.delta"))
+
+    if new_oldest > oldest:
+        messages.append(f"Removed {new_oldest - oldest} old revisions")
+
+    # keep files of older repositories get the oldest version, so that it is not searched for again
+    if not keep_has_oldest or new_oldest != oldest or prev_num_revisions_to_keep != num_revisions_to_keep:
+        stage_file(tx_path, ops, f"{path}/keep", data=f"{num_revisions_to_keep} {new_oldest}")
+
+    if os.path.exists(lock_file):
+        ops.append(("remove", f"{path}/lock"))
+
+    ops.append(("manifest", path, [version_num, new_oldest, 0, int(not os.path.exists(file)), commit_time]))
 
-            if num_revisions_to_keep == -1:
-                num_revisions_to_keep = 10
 
-            print(f"Adding {file} to the repository, keeping {num_revisions_to_keep} latest revisions")
-            os.makedirs(file_repo_path)
-            with open(os.path.join(file_repo_path, "keep"), "w") as f:
-                f.write(f"{num_revisions_to_keep}")
+def expand_commit_paths(repo_folder, paths):
+    # folders expand to the new and locked files in them, plus locked files deleted from the working copy
+    files = []
+    entries = None
+    for p in paths:
+        if p == "-":
+            files.extend(line.strip() for line in sys.stdin if line.strip())
+        elif os.path.isdir(p):
+            if entries is None:
+                entries = load_manifest(repo_folder)
 
-            version_num = 0
+            for dir_path, dir_names, file_names in os.walk(p):
+                dir_names[:] = sorted(name for name in dir_names if not name.startswith(reserved_prefix))
+                for name in sorted(file_names):
+                    file = os.path.join(dir_path, name)
+                    entry = entries.get(repo_path_of(file))
+                    if not name.startswith(reserved_prefix) and (entry is None or entry.locked):
+                        files.append(file)
+
+            prefix = repo_path_of(p) + "/"
+            for path, entry in sorted(entries.items()):
+                if entry.locked and (prefix == "./" or path.startswith(prefix)) and not os.path.exists(path):
+                    files.append(path)
         else:
-            versions = load_log(file_repo_path)
-            version_num = len(versions)
-            if os.path.exists(os.path.join(file_repo_path, str(version_num - 1))) and not os.path.exists(lock_file):
-                raise RuntimeError("File is not locked")
-
-            print(f"New version of [{file}]: {version_num}")
-            with open(os.path.join(file_repo_path, "keep"), "r") as f:
-                prev_num_revisions_to_keep = int(f.read())
-
-            if num_revisions_to_keep != -1 and prev_num_revisions_to_keep != num_revisions_to_keep:
-                print(f"Changing number of revisions to keep from {prev_num_revisions_to_keep} to {num_revisions_to_keep}")
-                with open(os.path.join(file_repo_path, "keep"), "w") as f:
-                    f.write(f"{num_revisions_to_keep}")
-            else:
-                num_revisions_to_keep = prev_num_revisions_to_keep
+            files.append(p)
+
+    unique_files = {}
+    for file in files:
+        unique_files.setdefault(repo_path_of(file), file)
+
+    return list(unique_files.values())
+
+
+def commit(repo_folder, paths, message, num_revisions_to_keep=-1):
+    # all files are staged first; publishing is a single rename of the journal, after which the batch is
+    # guaranteed to be applied completely, even if this process dies (see recover_transactions)
+    files = expand_commit_paths(repo_folder, paths)
+    if not files:
+        print("Nothing to commit")
+        return
+
+    held = lock_paths(repo_folder, [repo_path_of(file) for file in files])
+    try:
+        recover_transactions(repo_folder, held)
+        tx_path = os.path.join(repo_folder, staging_name, f"{os.getpid()}-{time.time_ns()}")
+        os.makedirs(tx_path)
+        tx_fd = os.open(tx_path, os.O_RDONLY)
+        try:
+            fcntl.flock(tx_fd, fcntl.LOCK_EX)
+            commit_time = int(time.time())
+            ops = []
+            messages = []
+            try:
+                for file in files:
+                    stage_commit(repo_folder, tx_path, file, message, num_revisions_to_keep, commit_time, ops, messages)
+
+                with open(os.path.join(tx_path, "journal.pending"), "w") as f:
+                    json.dump(ops, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+            except BaseException:
+                shutil.rmtree(tx_path)
+                raise
 
-        commit_time = int(time.time())
-        with open(os.path.join(file_repo_path, "log"), "a") as f:
-            message = message.replace("\t", "    ").replace("\n", "  ")
-            f.write(f"{message}\t{commit_time}\n")
+            os.rename(os.path.join(tx_path, "journal.pending"), os.path.join(tx_path, "journal"))
+            apply_journal(repo_folder, tx_path)
+        finally:
+            os.close(tx_fd)
+    finally:
+        unlock_paths(held)
 
+    for file in files:
         if os.path.exists(file):
-            shutil.copy(file, os.path.join(file_repo_path, str(version_num)))
             os.utime(file, (commit_time, commit_time))
             make_readonly(file)
 
-        removed_old_versions = 0
-        for ver_to_remove in range(version_num - num_revisions_to_keep, -1, -1):
-            ver_file = os.path.join(file_repo_path, str(ver_to_remove))
-            if os.path.exists(ver_file):
-                os.remove(ver_file)
-                removed_old_versions += 1
-
-        if removed_old_versions > 0:
-            print(f"Removed {removed_old_versions} old revisions")
-        
-        if os.path.exists(lock_file):
-            os.remove(lock_file)
-    elif command == "lock":
-        if len(sys.argv) != 4:
-            raise UsageError()        
-
-        assert os.path.exists(repo_folder) and os.path.isdir(repo_folder), "missing/wrong repository folder"
-        file = sys.argv[3]        
+    for line in messages:
+        print(line)
+
+    if len(files) > 1:
+        print(f"Committed {len(files)} files")
+
+
+def lock_maintenance(packs_path):
+    # pack and gc rewrite pack files; they exclude each other but never block commits or checkouts
+    fd = os.open(os.path.join(packs_path, "maintenance.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    return fd
+
+
+def pack(repo_folder):
+    # move all but the newest loose revisions of every file into one append-only pack with a sorted index.
+    # The index is renamed into place last, so a pack is never visible before it is complete
+    recover_transactions(repo_folder)
+    packs_path = os.path.join(repo_folder, packs_name)
+    os.makedirs(packs_path, exist_ok=True)
+    maintenance_fd = lock_maintenance(packs_path)
+    try:
+        pack_into(repo_folder, packs_path)
+    finally:
+        os.close(maintenance_fd)
+
+
+def pack_into(repo_folder, packs_path):
+    pack_path = os.path.join(packs_path, f"pack-{time.time_ns()}")
+    index = []
+    packed_files = []
+    with open(pack_path + ".pack.tmp", "wb") as f:
+        f.write(pack_magic)
+        for path, entry in sorted(load_manifest(repo_folder).items()):
+            file_repo_path = os.path.join(repo_folder, *path.split("/"))
+            digest = path_digest(path)
+            path_bytes = path.encode("utf8")
+            for version in sorted(loose_revisions(file_repo_path))[:-pack_loose_revisions]:
+                try:
+                    is_full, blob = read_revision(file_repo_path, version, None)
+                except RuntimeError:
+                    continue  # expired by a concurrent commit
+
+                kind = pack_kind_full if is_full else pack_kind_delta
+                f.write(pack_entry_header.pack(len(path_bytes), version, kind, len(blob)) + path_bytes)
+                index.append((digest, version, f.tell(), len(blob), kind))
+                f.write(blob)
+                packed_files.append(version_file(file_repo_path, version) if is_full else delta_file(file_repo_path, version))
+
+        f.flush()
+        os.fsync(f.fileno())
+
+    if not index:
+        os.remove(pack_path + ".pack.tmp")
+        print("Nothing to pack")
+        return
+
+    index.sort()
+    with open(pack_path + ".idx.tmp", "wb") as f:
+        f.write(pack_index_magic)
+        f.write(b"".join(pack_index_record.pack(*record) for record in index))
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(pack_path + ".pack.tmp", pack_path + ".pack")
+    os.replace(pack_path + ".idx.tmp", pack_path + ".idx")
+    for packed_file in packed_files:
+        try:
+            os.remove(packed_file)
+        except FileNotFoundError:
+            pass  # expired by a concurrent commit
+
+    print(f"Packed {len(index)} revisions into {os.path.basename(pack_path)}")
+
+
+def gc(repo_folder):
+    # one streaming pass over all packs: revisions older than the oldest kept version of their file (or of files no
+    # longer in the manifest) are dropped, the rest is merged into a single new pack
+    recover_transactions(repo_folder)
+    entries = compact_manifest(repo_folder)
+    packs_path = os.path.join(repo_folder, packs_name)
+    if not os.path.exists(packs_path):
+        print("Nothing to collect")
+        return
+
+    maintenance_fd = lock_maintenance(packs_path)
+    try:
+        collect_packs(packs_path, entries)
+    finally:
+        os.close(maintenance_fd)
+
+
+def collect_packs(packs_path, entries):
+    old_packs = sorted((name[:-4] for name in os.listdir(packs_path) if name.endswith(".idx")), reverse=True)
+    if not old_packs:
+        print("Nothing to collect")
+        return
+
+    pack_path = os.path.join(packs_path, f"pack-{time.time_ns()}")
+    index = []
+    seen = set()
+    reclaimed = 0
+    with open(pack_path + ".pack.tmp", "wb") as out:
+        out.write(pack_magic)
+        for name in old_packs:
+            with open(os.path.join(packs_path, name + ".pack"), "rb") as f:
+                if f.read(len(pack_magic)) != pack_magic:
+                    raise RuntimeError("Repository is broken")
+
+                while header := f.read(pack_entry_header.size):
+                    path_len, version, kind, blob_len = pack_entry_header.unpack(header)
+                    path_bytes = f.read(path_len)
+                    path = path_bytes.decode("utf8")
+                    entry = entries.get(path)
+                    if entry is None or version < entry.oldest or (path, version) in seen:
+                        f.seek(blob_len, os.SEEK_CUR)
+                        reclaimed += len(header) + path_len + blob_len
+                        continue
+
+                    seen.add((path, version))
+                    out.write(header + path_bytes)
+                    index.append((path_digest(path), version, out.tell(), blob_len, kind))
+                    out.write(f.read(blob_len))
+
+        out.flush()
+        os.fsync(out.fileno())
+
+    if index:
+        index.sort()
+        with open(pack_path + ".idx.tmp", "wb") as f:
+            f.write(pack_index_magic)
+            f.write(b"".join(pack_index_record.pack(*record) for record in index))
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(pack_path + ".pack.tmp", pack_path + ".pack")
+        os.replace(pack_path + ".idx.tmp", pack_path + ".idx")
+    else:
+        os.remove(pack_path + ".pack.tmp")
+
+    for name in old_packs:
+        os.remove(os.path.join(packs_path, name + ".idx"))
+        os.remove(os.path.join(packs_path, name + ".pack"))
+
+    print(f"Reclaimed {reclaimed} bytes, {len(index)} packed revisions kept in {len(old_packs)} -> {int(bool(index))} packs")
+
+
+def check_repo(repo_folder):
+    assert os.path.exists(repo_folder) and os.path.isdir(repo_folder), "missing/wrong repository folder"
+
+
+def create(repo_folder):
+    os.mkdir(repo_folder)
+    write_manifest(repo_folder, {})
+    print(f"New empty repository [{repo_folder}] has been created.")
+
+
+def lock(repo_folder, file):
+    check_repo(repo_folder)
+    file_repo_path = os.path.join(repo_folder, file)
+    assert os.path.exists(file_repo_path), f"not in repository: [{file}]"
+    held = lock_paths(repo_folder, [repo_path_of(file)])
+    try:
+        recover_transactions(repo_folder, held)
+        lock_file = os.path.join(file_repo_path, "lock")
+        try:
+            fd = os.open(lock_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            with open(lock_file, "r") as f:
+                owner = f.read().strip()
+
+            raise RuntimeError(f"file is already locked{' by ' + owner if owner else ''}")
+
+        try:
+            os.write(fd, f"{getpass.getuser()}@{socket.gethostname()} pid {os.getpid()} at {time.strftime('%Y-%m-%d %H:%M:%S')}\n".encode("utf8"))
+        finally:
+            os.close(fd)
+
+        update_manifest(repo_folder, repo_path_of(file), scan_entry(repo_folder, repo_path_of(file)))
+    finally:
+        unlock_paths(held)
+
+    if os.path.exists(file):
+        break_link(file)
+        make_writable(file)
+
+    print(f"[{file}] is locked. You can change it now, then commit the new version.")
+
+
+def checkout(repo_folder, file=None, need_version=None, link=False):
+    check_repo(repo_folder)
+    if file is None:
+        print("Checking out the latest version of the whole repository into current folder")
+        checkout_tree(repo_folder, ".", link)
+    else:
         file_repo_path = os.path.join(repo_folder, file)
         assert os.path.exists(file_repo_path), f"not in repository: [{file}]"
-        lock_file = os.path.join(file_repo_path, "lock")
-        if os.path.exists(lock_file):
-            raise RuntimeError("file is already locked")
+        assert need_version is None or need_version >= 0, "wrong version number requested"
+        print(checkout_file(file_repo_path, file, need_version, link=link, packed=file_packed_revisions(repo_folder, repo_path_of(file))))
 
-        with open(lock_file, "w"):
-            pass
-        
-        if os.path.exists(file):
-            make_writable(file)
 
-        print(f"[{file}] is locked. You can change it now, then commit the new version.")
-    elif command == "checkout":
-        if not (3 <= len(sys.argv) <= 5):
-            raise UsageError
+def log(repo_folder, file, num_entries=None):
+    check_repo(repo_folder)
+    file_repo_path = os.path.join(repo_folder, file)
+    assert os.path.exists(file_repo_path), f"not in repository: [{file}]"
+    packed = file_packed_revisions(repo_folder, repo_path_of(file))
+    num_versions = log_length(file_repo_path)
+    first = 0 if num_entries is None else max(0, num_versions - num_entries)
+    versions = read_log(file_repo_path, first)
+    print("Saved? Ver. Timestamp           Message")
+    for i, (message, timestamp) in reversed(list(enumerate(versions, first))):
+        line = ""
+        if version_exists(file_repo_path, i, packed):
+            line += "+      "
+        else:
+            line += "-      "
+
+        line += str(i).ljust(5) + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)).ljust(20) + message
+        print(line)
+
+
+def migrate(repo_folder):
+    check_repo(repo_folder)
+    recover_transactions(repo_folder)
+    num_migrated = 0
+    for path, file_repo_path in tracked_files(repo_folder):
+        held = lock_paths(repo_folder, [path])
+        try:
+            num_migrated += migrate_log(file_repo_path)
+        finally:
+            unlock_paths(held)
+
+    print(f"Converted {num_migrated} logs")
+
+
+def stats(repo_folder):
+    check_repo(repo_folder)
+    num_files = full_bytes = delta_bytes = delta_original_bytes = 0
+    for dir_path, dir_names, file_names in os.walk(repo_folder):
+        dir_names[:] = [name for name in dir_names if not name.startswith(reserved_prefix)]
+        if dir_names or dir_path == repo_folder:
+            continue
+
+        num_files += 1
+        for name in file_names:
+            path = os.path.join(dir_path, name)
+            if name.isdigit():
+                full_bytes += os.path.getsize(path)
+            elif name.endswith(".delta"):
+                delta_bytes += os.path.getsize(path)
+                with open(path, "rb") as f:
+                    delta_original_bytes += struct.unpack("<Q", f.read(8))[0]
+
+    # packed deltas keep the format of the loose ones
+    for idx, pack_data in load_packs(repo_folder):
+        for record_pos in range(len(pack_index_magic), len(idx), pack_index_record.size):
+            _, _, offset, length, kind = pack_index_record.unpack_from(idx, record_pos)
+            if kind == pack_kind_delta:
+                delta_bytes += length
+                delta_original_bytes += struct.unpack_from("<Q", pack_data, offset)[0]
+
+    print(f"Files: {num_files}")
+    print(f"Full revisions: {full_bytes} bytes")
+    print(f"Reverse deltas, loose and packed: {delta_bytes} bytes, {delta_original_bytes} bytes uncompressed")
+    print(f"Saved by deltas: {delta_original_bytes - delta_bytes} bytes")
+    pack_names = os.listdir(os.path.join(repo_folder, packs_name)) if os.path.exists(os.path.join(repo_folder, packs_name)) else []
+    pack_bytes = sum(os.path.getsize(os.path.join(repo_folder, packs_name, name)) for name in pack_names)
+    print(f"Packs: {sum(name.endswith('.pack') for name in pack_names)}, {pack_bytes} bytes")
+
+
+def main(argv):
+    try:
+        if len(argv) < 3:
+            raise UsageError()
+
+        command = argv[1]
+        repo_folder = argv[2]
+        if command == "create":
+            if len(argv) != 3:
+                raise UsageError()
 
-        assert os.path.exists(repo_folder) and os.path.isdir(repo_folder), "missing/wrong repository folder"
-        if len(sys.argv) == 3:
-            print("Checking out the latest version of the whole repository into current folder")
-            checkout_recursive(repo_folder, ".")
+            create(repo_folder)
+        elif command == "commit":
+            check_repo(repo_folder)
+            num_revisions_to_keep = -1
+            if len(argv) > 3 and argv[3] == "-m":
+                if len(argv) < 6:
+                    raise UsageError
+
+                message = argv[4]
+                paths = argv[5:]
+                if paths[0] == "-k":
+                    if len(paths) < 3:
+                        raise UsageError
+
+                    num_revisions_to_keep = int(paths[1])
+                    paths = paths[2:]
+            else:
+                if not (5 <= len(argv) <= 6):
+                    raise UsageError
+
+                paths = [argv[3]]
+                message = argv[4]
+                if len(argv) == 6:
+                    num_revisions_to_keep = int(argv[5])
+
+            assert num_revisions_to_keep == -1 or num_revisions_to_keep > 0, "wrong number of revisions to keep"
+            commit(repo_folder, paths, message, num_revisions_to_keep)
+        elif command == "lock":
+            if len(argv) != 4:
+                raise UsageError()
+
+            lock(repo_folder, argv[3])
+        elif command == "checkout":
+            checkout_args = [arg for arg in argv if arg != "--link"]
+            if not (3 <= len(checkout_args) <= 5):
+                raise UsageError
+
+            checkout(repo_folder, checkout_args[3] if len(checkout_args) > 3 else None,
+                     int(checkout_args[4]) if len(checkout_args) > 4 else None, "--link" in argv)
+        elif command == "log":
+            if not (4 <= len(argv) <= 5):
+                raise UsageError
+
+            log(repo_folder, argv[3], int(argv[4]) if len(argv) > 4 else None)
+        elif command == "pack":
+            if len(argv) != 3:
+                raise UsageError
+
+            check_repo(repo_folder)
+            pack(repo_folder)
+        elif command == "gc":
+            if not (3 <= len(argv) <= 4) or len(argv) == 4 and argv[3] != "--background":
+                raise UsageError
+
+            check_repo(repo_folder)
+            if len(argv) == 4:
+                pid = os.fork()
+                if pid != 0:
+                    print(f"Garbage collection is running in background, pid {pid}")
+                    exit(0)
+
+                os.setsid()
+                sys.stdout = open(os.devnull, "w")
+
+            gc(repo_folder)
+        elif command == "migrate":
+            if len(argv) != 3:
+                raise UsageError
+
+            migrate(repo_folder)
+        elif command == "status":
+            if len(argv) != 3:
+                raise UsageError
+
+            check_repo(repo_folder)
+            start_time = time.perf_counter()
+            report, num_checked, num_hashed = status(repo_folder, ".")
+            for line in report:
+                print(line)
+
+            print(f"{num_checked} files checked in {time.perf_counter() - start_time:.2f} s, {num_hashed} hashed")
+        elif command == "stats":
+            if len(argv) != 3:
+                raise UsageError
+
+            stats(repo_folder)
         else:
-            file = sys.argv[3]
-            file_repo_path = os.path.join(repo_folder, file)
-            assert os.path.exists(file_repo_path), f"not in repository: [{file}]"
-            need_version = None if len(sys.argv) < 5 else int(sys.argv[4])
-            assert need_version is None or need_version >= 0, "wrong version number requested"
-            checkout(file_repo_path, file, need_version)
-    elif command == "log":
-        if len(sys.argv) != 4:
+            print(f"Unknown command: {command}")
             raise UsageError
+    except UsageError:
+        print(usage)
+        exit(1)
+    except Exception as e:
+        print(f"Error: {e}")
+        exit(1)
 
-        assert os.path.exists(repo_folder) and os.path.isdir(repo_folder), "missing/wrong repository folder"
-        file = sys.argv[3]        
-        file_repo_path = os.path.join(repo_folder, file)
-        assert os.path.exists(file_repo_path), f"not in repository: [{file}]"    
-        versions = load_log(file_repo_path)
-        print("Saved? Ver. Timestamp           Message")
-        for i, (message, timestamp) in reversed(list(enumerate(versions))):
-            line = ""
-            if os.path.exists(os.path.join(file_repo_path, str(i))):
-                line += "+      "
-            else:
-                line += "-      "
 
-            line += str(i).ljust(5) + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)).ljust(20) + message
-            print(line)
-    else:
-        print(f"Unknown command: {command}")
-        raise UsageError
-except UsageError:
-    print(usage)
-    exit(1)
-except Exception as e:
-    print(f"Error: {e}")
-    exit(1)
+if __name__ == "__main__":
+    main(sys.argv)
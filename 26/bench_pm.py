@@ -0,0 +1,103 @@
+import argparse
+import contextlib
+import io
+import os
+import secrets
+import shutil
+import statistics
+import tempfile
+import time
+
+import pm
+
+
+parser = argparse.ArgumentParser(description="Benchmark pm.py storage operations on in-memory and SQLite backends.",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+parser.add_argument("--sizes", metavar="N,N,...", type=str, default="10,1000,100000", help="numbers of stored passwords to test with")
+parser.add_argument("--backends", metavar="NAME,...", type=str, default="memory,sqlite", help="backends to test: memory, sqlite")
+parser.add_argument("--sample", metavar="N", type=int, default=100, help="number of store and get calls measured at each size")
+parser.add_argument("--kdf-n", metavar="N", type=int, default=2 ** 4,
+                    help="scrypt cost parameter. Low by default so that the storage cost is measured rather than key derivation")
+parser.add_argument("--vault", action="store_true", help="convert the storage to the vault layout before measuring")
+
+
+def quiet():
+    stack = contextlib.ExitStack()
+    stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+    stack.enter_context(contextlib.redirect_stderr(io.StringIO()))
+    return stack
+
+
+def measure(results, name, count, calls):
+    # calls is a list of functions, each timed separately for the latency percentiles
+    latencies = []
+    with quiet():
+        for call in calls:
+            start_time = time.perf_counter()
+            call()
+            latencies.append(time.perf_counter() - start_time)
+
+    results.append((name, count, sum(latencies), latencies))
+
+
+def make_backend(name, folder):
+    if name == "memory":
+        return pm.MemoryBackend()
+
+    if name == "sqlite":
+        return pm.SqliteBackend(os.path.join(folder, f"bench-{secrets.token_hex(4)}.sqlite3"))
+
+    raise ValueError(f"unknown backend {name}")
+
+
+def bench_size(backend_name, size, args, folder):
+    pm.backend = make_backend(backend_name, folder)
+    pm.args = argparse.Namespace(secret=False, jobs=1)
+    results = []
+    with quiet():
+        master_key = pm.retrieve_master_key()
+        if args.vault:
+            pm.convert_to_vault(master_key)
+
+    entries = [(f"site{i}.example.com", secrets.token_urlsafe(12)) for i in range(size)]
+    measure(results, "import", size, [lambda: pm.import_passwords(entries, master_key, True)])
+    new_keys = [f"new{i}.example.com" for i in range(args.sample)]
+    measure(results, "store", len(new_keys), [lambda key=key: pm.add_password(key, "password", master_key, True) for key in new_keys])
+    sample = [key for key, _ in secrets.SystemRandom().sample(entries, min(args.sample, size))]
+    measure(results, "get", len(sample), [lambda key=key: pm.get_password(key, master_key) for key in sample])
+    measure(results, "list", 1, [lambda: pm.list_keys(master_key)])
+    backup_file = os.path.join(folder, "bench.backup")
+    measure(results, "backup", 1, [lambda: pm.backup(backup_file, "backup password")])
+    measure(results, "restore", 1, [lambda: pm.restore(backup_file, "backup password")])
+    os.remove(backup_file)
+    return results
+
+
+def print_results(backend_name, size, results):
+    print(f"{backend_name}, {size} passwords")
+    print(f"{'Operation':<12}{'Count':>8}{'Total, s':>10}{'Ops/s':>10}{'Mean, ms':>10}{'p50, ms':>10}{'p95, ms':>10}")
+    for name, count, elapsed, latencies in results:
+        latencies = sorted(latencies)
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        print(f"{name:<12}{count:>8}{elapsed:>10.3f}{count / max(elapsed, 1e-9):>10.1f}{elapsed / len(latencies) * 1000:>10.2f}"
+              f"{statistics.median(latencies) * 1000:>10.2f}{p95 * 1000:>10.2f}")
+
+    print()
+
+
+def main():
+    args = parser.parse_args()
+    pm.kdf_params["n"] = args.kdf_n
+    folder = tempfile.mkdtemp(prefix="pm_bench_")
+    os.environ["XDG_RUNTIME_DIR"] = folder  # keeps the benchmark away from a running agent
+    try:
+        for backend_name in args.backends.split(","):
+            for size in map(int, args.sizes.split(",")):
+                print_results(backend_name, size, bench_size(backend_name, size, args, folder))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import pm
+
+
+parser = argparse.ArgumentParser(description="Measure the cold start time of pm.py commands. Exits with an error when a command is over its budget.",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+parser.add_argument("--runs", metavar="N", type=int, default=10, help="runs of each command. The median time is compared with the budget")
+parser.add_argument("--gen-budget-ms", metavar="MS", type=float, default=200, help="budget for 'gen --print'")
+parser.add_argument("--get-budget-ms", metavar="MS", type=float, default=400,
+                    help="budget for 'get --print' on a storage with cheap key derivation, so that startup dominates")
+
+parser.add_argument("--backend", choices=["keyring", "sqlite"], default="sqlite",
+                    help="backend for 'get'. The keyring backend uses the real system keyring")
+
+
+pm_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pm.py")
+
+
+def prepare_storage(args, folder):
+    # a storage with one password, whose lookup key derivation is made cheap by a calibration record
+    db = os.path.join(folder, "startup.sqlite3")
+    pm.backend = pm.SqliteBackend(db) if args.backend == "sqlite" else pm.KeyringBackend()
+    pm.args = argparse.Namespace(secret=False, jobs=1)
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        master_key = pm.retrieve_master_key()
+        versions = pm.read_kdf_versions(master_key)
+        cheap_params = dict(n=2 ** 10, r=8, p=1)
+        if versions[-1] != cheap_params:
+            pm.write_kdf_versions(versions + [cheap_params], master_key)
+
+        pm.add_password("startup benchmark", "password", master_key, False)
+
+    return ["--backend", args.backend, "--db", db]
+
+
+def run_times(command, runs, env):
+    times = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable, pm_path] + command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start_time)
+
+    return times
+
+
+def slowest_imports(command, env, num_imports=10):
+    result = subprocess.run([sys.executable, "-X", "importtime", pm_path] + command, env=env, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, text=True)
+
+    imports = []
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, name = line[len("import time:"):].split("|")
+            if cumulative.strip().isdigit():
+                imports.append((int(cumulative), name.rstrip()))
+
+    return sorted(imports, reverse=True)[:num_imports]
+
+
+def main():
+    args = parser.parse_args()
+    folder = tempfile.mkdtemp(prefix="pm_startup_")
+    env = dict(os.environ, XDG_RUNTIME_DIR=folder)  # no agent: the commands run as from a cold shell
+    os.environ["XDG_RUNTIME_DIR"] = folder
+    try:
+        storage_args = prepare_storage(args, folder)
+        interpreter_times = []
+        for _ in range(args.runs):
+            start_time = time.perf_counter()
+            subprocess.run([sys.executable, "-c", "pass"], env=env, check=True)
+            interpreter_times.append(time.perf_counter() - start_time)
+
+        print(f"Interpreter startup: {statistics.median(interpreter_times) * 1000:.0f} ms")
+        over_budget = False
+        for name, command, budget_ms in [("gen --print", ["gen", "--print"], args.gen_budget_ms),
+                                         ("get --print", storage_args + ["get", "startup benchmark", "--print"], args.get_budget_ms)]:
+            median_ms = statistics.median(run_times(command, args.runs, env)) * 1000
+            verdict = "ok" if median_ms <= budget_ms else "OVER BUDGET"
+            print(f"{name:<14}{median_ms:>8.0f} ms  budget {budget_ms:.0f} ms  {verdict}")
+            if median_ms > budget_ms:
+                over_budget = True
+                print("  Slowest imports (cumulative):")
+                for microseconds, module in slowest_imports(command, env):
+                    print(f"  {microseconds / 1000:>8.1f} ms {module}")
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    if over_budget:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,147 +1,581 @@
 import argparse
+import functools
+import io
+import math
 import secrets
+import sys
 import string
-from collections import Counter
 import hashlib
 import getpass
+import json
+import os
+import struct
+import time
+from collections import deque
 
-import keyring
-import xerox
-from Crypto.Cipher import AES
-from tqdm import trange, tqdm
+# keyring, xerox, Crypto, tqdm and the modules for parallel work and for the agent are imported where they are used: loading them
+# takes longer than generating a password
 
 
 storage_bytes = 256
+vault_shard_bytes = 4096
+backup_magic = b"PMB3"
+backup_chunk_bytes = 2 ** 16
 key_bits = 256
 default_password_abc = " ".join([string.ascii_lowercase, string.ascii_uppercase, string.digits, "_@#$.!+-="])
 default_password_len = 15
 tag1 = "a919bf9b298b14a1893b71954520a7fa1bdc2c67903979bd0db9824039bd71506d91648bfd3083708ebb85261c82824544fa508ad90990b503e474d20c1889b4"
 tag2 = "c97ab2ad0555b0d0f2613f4b144cd9ec9116be3cc377aca9b9754094be91c7431f0c10363284a11566219a467f579772d1e16654a62b12e77dabd25ad3842865"
+max_index_prefix_chars = 2  # the index of stored keys is split into up to 16 ** max_index_prefix_chars shards by the first characters of the keys
+index_shard_keys = 256  # the number of shards is chosen for about this many keys per shard
 default_storage_key = bytearray.fromhex("601a6d376f80a6a7fc2a0f0bf17fce76303b37069c8830eca622406d38361499")
+kdf_params = dict(n=2 ** 20, r=8, p=1)  # scrypt parameters of the storages and backups made before any calibration
 
 
-parser = argparse.ArgumentParser(description='Password manager. Generates passwords and, optionally, stores them in the system keyring.',
-                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+def add_secret_argument(parser):
+    parser.add_argument("--secret", action="store_true", help="use a secret storage. You will be asked for the storage password")
 
-subparsers = parser.add_subparsers(help='a command. Add -h for command help', dest="command")
-parser_gen = subparsers.add_parser('gen', help='generate a random password. Do not store it', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-parser_gen.add_argument('--nchars', metavar="N", type=int, default=default_password_len, help='number of characters for generated password')
-parser_gen.add_argument("--alphabet", metavar="CHARS", type=str, default=default_password_abc,
-                    help="alphabet for password generation. Enclose in quotes. Separate required groups (like uppercase and lowercase letters) with spaces")
 
-parser_gen.add_argument("--print", action="store_true", help="show the password on the screen instead of copying it into clipboard")
+def add_generation_arguments(parser):
+    parser.add_argument('--nchars', metavar="N", type=int, default=default_password_len, help='number of characters for generated password')
+    parser.add_argument("--alphabet", metavar="CHARS", type=str, default=default_password_abc,
+                        help="alphabet for password generation. Enclose in quotes. Separate required groups (like uppercase and lowercase letters) with spaces")
 
-parser_store = subparsers.add_parser('store', help='generate (or enter) and store a password', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-parser_store.add_argument("key", metavar="KEY", type=str, help="the key (e.g., website name) under which the password will be stored")
-parser_store.add_argument("--secret", action="store_true", help="use a secret storage. You will be asked for the storage password")
-parser_store.add_argument("--hidden", action="store_true", help="hide this key from the list of stored keys returned by 'list' command")
-parser_store.add_argument("--input", action="store_true", help="input a password for storage from keyboard instead of generating it")
-parser_store.add_argument('--nchars', metavar="N", type=int, default=default_password_len, help='number of characters for generated password')
-parser_store.add_argument("--alphabet", metavar="CHARS", type=str, default=default_password_abc,
-                    help="alphabet for password generation. Enclose in quotes. Separate required groups (like uppercase and lowercase letters) with spaces")
 
-parser_store.add_argument("--output", action="store_true", help="output the generated password")
-parser_store.add_argument("--print", action="store_true", help="show the password on the screen instead of copying it into clipboard")
+def add_print_argument(parser):
+    parser.add_argument("--print", action="store_true", help="show the password on the screen instead of copying it into clipboard")
 
-parser_get = subparsers.add_parser('get', help='retrieve a stored password', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-parser_get.add_argument("key", metavar="KEY", type=str, help="the key (e.g., website name) under which the password was stored")
-parser_get.add_argument("--secret", action="store_true", help="use a secret storage. You will be asked for the storage password")
-parser_get.add_argument("--print", action="store_true", help="show the password on the screen instead of copying it into clipboard")
 
-parser_list = subparsers.add_parser('list', help='list visible keys for which passwords are stored', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-parser_list.add_argument("--secret", action="store_true", help="use a secret storage. You will be asked for the storage password")
+def add_gen_arguments(parser):
+    add_generation_arguments(parser)
+    add_print_argument(parser)
+    parser.add_argument("--count", metavar="N", type=int, default=1, help="number of passwords to generate, one per line")
 
-parser_nuke = subparsers.add_parser('nuke', help='delete all storages', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
-parser_backup = subparsers.add_parser('backup', help='save all storages into an encrypted file', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-parser_backup.add_argument("file", metavar="FILE", type=str, help="backup file name")
+def add_store_arguments(parser):
+    parser.add_argument("key", metavar="KEY", type=str, help="the key (e.g., website name) under which the password will be stored")
+    add_secret_argument(parser)
+    parser.add_argument("--hidden", action="store_true", help="hide this key from the list of stored keys returned by 'list' command")
+    parser.add_argument("--input", action="store_true", help="input a password for storage from keyboard instead of generating it")
+    add_generation_arguments(parser)
+    parser.add_argument("--output", action="store_true", help="output the generated password")
+    add_print_argument(parser)
 
-parser_restore = subparsers.add_parser('restore', help='restore storages from a backup file (nukes current storage)', 
-    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
-parser_restore.add_argument("file", metavar="FILE", type=str, help="backup file name")
+def add_get_arguments(parser):
+    parser.add_argument("key", metavar="KEY", type=str, help="the key (e.g., website name) under which the password was stored")
+    add_secret_argument(parser)
+    add_print_argument(parser)
 
-args = parser.parse_args()
 
+def add_backup_arguments(parser):
+    parser.add_argument("file", metavar="FILE", type=str, help="backup file name")
+    parser.add_argument("--jobs", metavar="N", type=int, default=8,
+                        help="number of concurrent keyring calls. Use 1 for keyring backends that are not thread-safe, like file-based ones")
 
-def gen_password():
+
+def add_derivation_jobs_argument(parser):
+    parser.add_argument("--jobs", metavar="N", type=int, default=0,
+                        help="number of processes for key derivation. Each needs about 1 GB of memory. 0 to choose by the free memory")
+
+
+def add_import_arguments(parser):
+    add_secret_argument(parser)
+    parser.add_argument("--hidden", action="store_true", help="hide the imported keys from the list of stored keys returned by 'list' command")
+    parser.add_argument("--format", choices=["auto", "csv", "json"], default="auto", help="input format")
+    add_derivation_jobs_argument(parser)
+
+
+def add_calibrate_arguments(parser):
+    parser.add_argument("--secret", action="store_true", help="calibrate a secret storage. You will be asked for the storage password")
+    parser.add_argument("--target-ms", metavar="MS", type=float, default=1000, help="longest acceptable time of one key derivation")
+    parser.add_argument("--max-memory-mb", metavar="MB", type=float, default=1024, help="largest acceptable memory of one key derivation")
+
+
+def add_unlock_arguments(parser):
+    parser.add_argument("--secret", action="store_true", help="unlock a secret storage. You will be asked for the storage password. "
+                        "While the agent runs, commands with --secret use this storage")
+
+    parser.add_argument("--timeout", metavar="MINUTES", type=float, default=15, help="forget the keys after this much inactivity")
+
+
+def add_vault_arguments(parser):
+    parser.add_argument("--secret", action="store_true", help="convert a secret storage. You will be asked for the storage password")
+    add_derivation_jobs_argument(parser)
+
+
+commands = {
+    "gen": ("generate a random password. Do not store it", add_gen_arguments),
+    "store": ("generate (or enter) and store a password", add_store_arguments),
+    "get": ("retrieve a stored password", add_get_arguments),
+    "list": ("list visible keys for which passwords are stored", add_secret_argument),
+    "nuke": ("delete all storages", None),
+    "backup": ("save all storages into an encrypted file", add_backup_arguments),
+    "restore": ("restore storages from a backup file (nukes current storage)", add_backup_arguments),
+    "import": ("store many passwords read from stdin, as CSV (key,password rows) or JSON "
+               '({"key": "password", ...} or [{"key": ..., "password": ...}, ...])', add_import_arguments),
+    "calibrate": ("choose the key derivation cost for this machine and store it in the storage. The default storage parameters are also "
+                  "used for secret storage passwords and backups. Existing entries are migrated when they are accessed", add_calibrate_arguments),
+    "unlock": ("start an agent that keeps the storage unlocked, so that following commands do not ask for the storage password and skip "
+               "key derivation", add_unlock_arguments),
+    "vault": ("convert a storage to the vault layout: all its passwords are kept in one encrypted blob (split into a few shards of equal "
+              "size), so that commands need fewer keyring calls", add_vault_arguments),
+    "lock": ("stop the agent and forget the keys it holds", None),
+}
+
+
+def build_parser(argv):
+    # only the subparser of the given command is built. All of them are built for the general help
+    parser = argparse.ArgumentParser(description='Password manager. Generates passwords and, optionally, stores them in the system keyring.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("--backend", choices=["keyring", "sqlite"], default="keyring", help="where the storages are kept")
+    parser.add_argument("--db", metavar="FILE", type=str, default=os.path.join(os.path.expanduser("~"), ".pm.sqlite3"),
+                        help="database file for the sqlite backend")
+
+    parser.add_argument("--profile", action="store_true", help="print the time and the number of calls of each phase of the command to stderr")
+    parser.add_argument("--profile-format", choices=["text", "json"], default="text", help="format of the --profile report")
+
+    subparsers = parser.add_subparsers(help='a command. Add -h for command help', dest="command")
+    option_values = [argv[i + 1] for i in range(len(argv) - 1) if argv[i] in ("--backend", "--db", "--profile-format")]
+    command = next((arg for arg in argv if arg in commands and arg not in option_values), None)
+    for name, (help, add_arguments) in commands.items():
+        if command is None or name == command:
+            subparser = subparsers.add_parser(name, help=help, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+            if add_arguments is not None:
+                add_arguments(subparser)
+
+    return parser
+
+
+profile = None  # phase name -> [number of calls, seconds], while --profile is on
+
+
+def add_to_profile(phase, seconds):
+    if profile is None:
+        return
+
+    with profile_lock:
+        stats = profile.setdefault(phase, [0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+
+
+def profiled(phase):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if profile is None:
+                return fn(*args, **kwargs)
+
+            start_time = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                add_to_profile(phase, time.perf_counter() - start_time)
+
+        return wrapper
+
+    return decorator
+
+
+def print_profile(command, wall_time, format):
+    if format == "json":
+        phases = {phase: {"calls": calls, "ms": seconds * 1000} for phase, (calls, seconds) in profile.items()}
+        print(json.dumps({"command": command, "wall_ms": wall_time * 1000, "phases": phases}), file=sys.stderr)
+        return
+
+    print(f"{'Phase':<16}{'Calls':>8}{'Total, ms':>12}{'Share':>8}", file=sys.stderr)
+    for phase, (calls, seconds) in sorted(profile.items(), key=lambda item: -item[1][1]):
+        print(f"{phase:<16}{calls:>8}{seconds * 1000:>12.1f}{seconds / wall_time:>8.1%}", file=sys.stderr)
+
+    print(f"Wall time of '{command}': {wall_time * 1000:.1f} ms. Nested phases are also counted in the enclosing ones, "
+          f"and calls from parallel threads add up", file=sys.stderr)
+
+
+class KeyringBackend:
+    # the system keyring. All entries are kept under the same service name
+    name = "keyring"
+
+    @profiled("keyring get")
+    def get(self, name):
+        import keyring
+        return keyring.get_password(tag1, name)
+
+    @profiled("keyring set")
+    def set(self, name, value):
+        import keyring
+        keyring.set_password(tag1, name, value)
+
+    @profiled("keyring delete")
+    def delete(self, name):
+        import keyring
+        keyring.delete_password(tag1, name)
+
+
+class MemoryBackend:
+    # entries in a dict, for tests and benchmarks
+    def __init__(self):
+        self.name = f"memory:{id(self)}"
+        self.entries = {}
+
+    def get(self, name):
+        return self.entries.get(name)
+
+    def set(self, name, value):
+        self.entries[name] = value
+
+    def delete(self, name):
+        del self.entries[name]
+
+
+class SqliteBackend:
+    # entries in a local SQLite file, shared by the threads of backup and restore
+    def __init__(self, path):
+        import sqlite3
+        import threading
+        self.name = f"sqlite:{os.path.abspath(path)}"
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS entries (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.lock = threading.Lock()
+
+    @profiled("sqlite get")
+    def get(self, name):
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM entries WHERE name = ?", (name,)).fetchone()
+
+        return None if row is None else row[0]
+
+    @profiled("sqlite set")
+    def set(self, name, value):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO entries (name, value) VALUES (?, ?)", (name, value))
+
+    @profiled("sqlite delete")
+    def delete(self, name):
+        with self.lock:
+            if self.connection.execute("DELETE FROM entries WHERE name = ?", (name,)).rowcount == 0:
+                raise KeyError(name)
+
+
+args = None
+backend = KeyringBackend()
+
+
+def count_passwords(group_sizes, nchars):
+    # ways[j][m] is the number of strings of m characters from groups j, j + 1, ..., containing at least two characters of each group
+    ways = [[0] * (nchars + 1) for _ in range(len(group_sizes) + 1)]
+    ways[-1][0] = 1
+    for j in reversed(range(len(group_sizes))):
+        for m in range(nchars + 1):
+            ways[j][m] = sum(math.comb(m, c) * group_sizes[j] ** c * ways[j + 1][m - c] for c in range(2, m + 1))
+
+    return ways
+
+
+def secure_shuffle(items):
+    for i in reversed(range(1, len(items))):
+        j = secrets.randbelow(i + 1)
+        items[i], items[j] = items[j], items[i]
+
+
+def gen_passwords(count):
+    # samples uniformly from all the passwords with at least two characters of each group: first the number of characters of each
+    # group, weighted by the number of passwords with these counts, then their positions and the characters themselves
     abcs = list(map(frozenset, args.alphabet.split(" ")))
-    abc = list(frozenset.union(*abcs))
     char_part = {}
     for i, chars in enumerate(abcs):
         for c in chars:
             char_part[c] = i
 
+    groups = [sorted(c for c, part in char_part.items() if part == i) for i in range(len(abcs))]
     assert args.nchars >= 1, "wrong password length selected"
     assert args.nchars >= len(abcs) * 2, "requested password length is too short for the chosen alphabet"
-    while True:
-        candidate = ''.join(secrets.choice(abc) for _ in range(args.nchars))
-        part_counts = Counter(char_part[c] for c in candidate)
-        if all(part_counts[p] >= 2 for p in range(len(abcs))):
-            return candidate
+    assert all(len(group) > 0 for group in groups), "empty character group in the alphabet"
+    ways = count_passwords([len(group) for group in groups], args.nchars)
+    passwords = []
+    for _ in range(count):
+        parts = []
+        remaining = args.nchars
+        for j, group in enumerate(groups):
+            r = secrets.randbelow(ways[j][remaining])
+            for num_chars in range(2, remaining + 1):
+                weight = math.comb(remaining, num_chars) * len(group) ** num_chars * ways[j + 1][remaining - num_chars]
+                if r < weight:
+                    break
+
+                r -= weight
+
+            parts.extend([j] * num_chars)
+            remaining -= num_chars
+
+        secure_shuffle(parts)
+        passwords.append("".join(secrets.choice(groups[part]) for part in parts))
+
+    return passwords, math.log2(ways[0][args.nchars])
+
+
+def gen_password():
+    return gen_passwords(1)[0][0]
 
 
 def output(pw):
     if args.print:
         print(pw)
     else:
-        xerox.copy(pw)
+        copy_to_clipboard(pw)
         print("Your password is copied to the clipboard")
 
 
-def key_from_password(pw: str, salt: bytes):
-    return hashlib.scrypt(pw.encode("utf8"), salt=salt, dklen=key_bits // 8, n=2 ** 20, r = 8, p = 1, maxmem=2 * 10 ** 9)
+@profiled("clipboard")
+def copy_to_clipboard(pw):
+    import xerox
+    try:
+        xerox.copy(pw)
+    except xerox.base.XclipNotFound:
+        print("Please install xclip")
+        exit(1)
+
+
+def kdf_memory(params):
+    return 128 * params["r"] * (params["n"] + params["p"] + 2)
+
+
+@profiled("scrypt")
+def key_from_password(pw: str, salt: bytes, params=None):
+    params = params or kdf_params
+    return hashlib.scrypt(pw.encode("utf8"), salt=salt, dklen=key_bits // 8, **params, maxmem=min(2 ** 31 - 1, kdf_memory(params) + 2 ** 20))
+
+
+def timed_key_from_password(pw: str, salt: bytes, params=None):
+    # for worker processes, whose profile is lost: the parent adds the returned time to its own
+    start_time = time.perf_counter()
+    key = key_from_password(pw, salt, params)
+    return key, time.perf_counter() - start_time
+
+
+def encode_kdf_params(params):
+    return bytes([params["n"].bit_length() - 1, params["r"], params["p"]])
+
+
+def decode_kdf_params(data):
+    return dict(n=2 ** data[0], r=data[1], p=data[2])
+
+
+def calibrate_kdf(target_seconds, max_memory):
+    # doubles n while the derivation fits the time and memory limits. The time grows linearly with n
+    params = dict(n=2 ** 14, r=8, p=1)
+    best = None
+    while kdf_memory(params) <= min(max_memory, 2 ** 31 - 2 ** 21):
+        start_time = time.perf_counter()
+        key_from_password("calibration", secrets.token_bytes(16), params)
+        elapsed = time.perf_counter() - start_time
+        if best is not None and elapsed > target_seconds:
+            break
+
+        best = dict(params), elapsed
+        if elapsed * 2 > target_seconds:
+            break
+
+        params["n"] *= 2
+
+    assert best is not None, "memory limit is too low"
+    return best
 
 
 def random_key():
     return secrets.token_bytes(key_bits // 8)
 
 
-def add_keys_to_index(keys):
-    assert all(len(k) == 128 for k in keys)
+def index_shard_tag(prefix):
+    return hashlib.blake2b((tag2 + prefix).encode("utf8")).hexdigest()
+
+
+index_directory_tag = index_shard_tag("/shards")
+index_directory_cache = None  # (backend, directory) read or written last
+
+
+def split_keys(keys_string):
+    return [keys_string[i:i + 128] for i in range(0, len(keys_string), 128)]
+
+
+def group_by_prefix(keys, prefix_chars):
+    groups = {}
+    for key in keys:
+        groups.setdefault(key[:prefix_chars], set()).add(key)
+
+    return groups
+
+
+def read_index_shard(prefix):
+    try:
+        return backend.get(index_shard_tag(prefix))
+    except:
+        return None
+
+
+def write_index_shard(prefix, keys):
+    backend.set(index_shard_tag(prefix), "".join(sorted(keys)))
+
+
+def delete_index_shard(prefix):
+    try:
+        backend.delete(index_shard_tag(prefix))
+    except:
+        backend.set(index_shard_tag(prefix), "")
+
+
+def read_index_directory():
+    # the directory lists the shards that exist and the length of their prefixes, so that only those are read and written
+    global index_directory_cache
+    if index_directory_cache is not None and index_directory_cache[0] is backend:
+        return index_directory_cache[1]
+
+    try:
+        data = backend.get(index_directory_tag)
+    except:
+        data = None
+
+    if not data:
+        return None
+
+    directory = json.loads(data)
+    index_directory_cache = backend, directory
+    return directory
+
+
+def write_index_directory(directory):
+    global index_directory_cache
+    backend.set(index_directory_tag, json.dumps(directory))
+    index_directory_cache = backend, directory
+
+
+def write_index(keys, old_directory, num_threads=1):
+    # writes the keys into as many shards as their number needs. The shards that are no longer listed are deleted afterwards
+    keys = set(keys)
+    prefix_chars = 0
+    while prefix_chars < max_index_prefix_chars and len(keys) > index_shard_keys * 16 ** prefix_chars:
+        prefix_chars += 1
+
+    groups = group_by_prefix(keys, prefix_chars)
+    for _, future in run_bounded(lambda group: write_index_shard(*group), groups.items(), num_threads):
+        future.result()
+
+    directory = {"prefix_chars": prefix_chars, "shards": sorted(groups)}
+    write_index_directory(directory)
+    stale_shards = set(old_directory["shards"]).difference(groups) if old_directory is not None else set()
+    for _, future in run_bounded(delete_index_shard, sorted(stale_shards), num_threads):
+        future.result()
+
+    return directory
+
+
+def migrate_index(num_threads=1):
+    # older versions kept the whole index in a single entry. Its keys are moved into the shards
+    try:
+        legacy_keys = backend.get(tag2)
+    except:
+        legacy_keys = None
+
+    if legacy_keys is None:
+        return None
+
+    directory = write_index(split_keys(legacy_keys), None, num_threads)
     try:
-        existing_keys = keyring.get_password(tag1, tag2)
-        assert existing_keys is not None
+        backend.delete(tag2)
     except:
-        existing_keys = ""
+        backend.set(tag2, "")
+
+    return directory
+
+
+def load_index_directory(num_threads=1):
+    # None for a storage without an index
+    directory = read_index_directory()
+    if directory is None:
+        directory = migrate_index(num_threads)
+
+    return directory
+
+
+@profiled("index update")
+def add_keys_to_index(keys):
+    assert all(len(k) == 128 for k in keys)
+    directory = load_index_directory() or {"prefix_chars": 0, "shards": []}
+    shards = set(directory["shards"])
+    new_shards = set()
+    oversized = False
+    for prefix, new_keys in group_by_prefix(keys, directory["prefix_chars"]).items():
+        existing_keys = split_keys(read_index_shard(prefix) or "") if prefix in shards else []
+        if not new_keys.issubset(existing_keys):
+            shard_keys = new_keys.union(existing_keys)
+            write_index_shard(prefix, shard_keys)
+            oversized = oversized or len(shard_keys) > 2 * index_shard_keys
+            if prefix not in shards:
+                new_shards.add(prefix)
+
+    if oversized and directory["prefix_chars"] < max_index_prefix_chars:
+        write_index(set(iter_index()).union(keys), directory)
+    elif new_shards or read_index_directory() is None:
+        write_index_directory({"prefix_chars": directory["prefix_chars"], "shards": sorted(shards | new_shards)})
+
+
+@profiled("index update")
+def replace_index(keys, num_threads=1):
+    write_index(keys, load_index_directory(num_threads), num_threads)
+
+
+def iter_index(num_threads=1):
+    directory = load_index_directory(num_threads)
+    if directory is None:
+        raise RuntimeError("Storage not initialized")
 
-    existing_keys_list = [existing_keys[i:i + 128] for i in range(0, len(existing_keys), 128)]
-    existing_keys_list.extend(keys)
-    existing_keys_list.sort()
-    keyring.set_password(tag1, tag2, "".join(existing_keys_list))
+    for prefix, future in run_bounded(read_index_shard, directory["shards"], num_threads):
+        shard = future.result()
+        if shard is not None:
+            assert len(shard) % 128 == 0, "Storage is damaged"
+            yield from split_keys(shard)
+
+
+index_batch = None  # when a list, new keys are collected in it instead of being added to the index one by one
 
 
 def store(key, value):
     assert len(key) == 128
-    keyring.set_password(tag1, key, value)
-    add_keys_to_index([key])
+    backend.set(key, value)
+    if index_batch is not None:
+        index_batch.append(key)
+    else:
+        add_keys_to_index([key])
 
 
-def store_padded(tag, info: bytes):
-    assert len(info) <= storage_bytes, "storage capacity exceeded (password or key too long?)"
-    if len(info) < storage_bytes:
-        info += secrets.token_bytes(storage_bytes - len(info))
+def store_padded(tag, info: bytes, size_bytes=storage_bytes):
+    assert len(info) <= size_bytes, "storage capacity exceeded (password or key too long?)"
+    if len(info) < size_bytes:
+        info += secrets.token_bytes(size_bytes - len(info))
 
     store(tag, info.hex())
 
 
 def get_padded(tag, size_bytes):
-    return bytearray.fromhex(keyring.get_password(tag1, tag))[:size_bytes]
+    return bytearray.fromhex(backend.get(tag))[:size_bytes]
 
 
-def store_encrypted(tag, info, key):
+def store_encrypted(tag, info, key, size_bytes=storage_bytes):
     info_len = len(info).to_bytes(4, byteorder="little")
-    padding_len = storage_bytes - len(info) - 36
+    padding_len = size_bytes - len(info) - 36
     if padding_len > 0:
         message = info_len + info + secrets.token_bytes(padding_len)
     else:
         message = info_len + info
 
-    store_padded(tag, encrypt(message, key))
+    store_padded(tag, encrypt(message, key), size_bytes)
 
 
-def get_encrypted(tag, key):
-    cipher_data = get_padded(tag, storage_bytes)
+def get_encrypted(tag, key, size_bytes=storage_bytes):
+    cipher_data = get_padded(tag, size_bytes)
     message = decrypt(cipher_data, key)
     payload_len = int.from_bytes(message[:4], byteorder="little")
     assert payload_len >= 0
@@ -149,16 +583,20 @@ def get_encrypted(tag, key):
     return message[4:4 + payload_len]
 
 
+@profiled("encrypt")
 def encrypt(message, key):
+    from Crypto.Cipher import AES
     cipher = AES.new(key, AES.MODE_EAX)
     ciphertext, tag = cipher.encrypt_and_digest(message)
     return cipher.nonce + tag + ciphertext
 
 
+@profiled("decrypt")
 def decrypt(cipher_data, key):
     nonce = cipher_data[:16]
     tag = cipher_data[16:32]
     ciphertext = cipher_data[32:]
+    from Crypto.Cipher import AES
     cipher = AES.new(key, AES.MODE_EAX, nonce)
     return cipher.decrypt_and_verify(ciphertext, tag)
 
@@ -169,17 +607,363 @@ def keyed_hash(data, key):
     return h.hexdigest()
 
 
-def store_encrypted_by_key(storage_key, data_to_store, encryption_key):
-    store_encrypted(keyed_hash(storage_key, encryption_key), data_to_store, encryption_key)
+def agent_socket_path():
+    import tempfile
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.path.join(runtime_dir, f"pm-agent-{os.getuid()}", "agent.sock")
+
+
+def peer_uid(conn):
+    import socket
+    if not hasattr(socket, "SO_PEERCRED"):
+        return os.getuid()  # the socket folder is only accessible by the user
+
+    pid, uid, gid = struct.unpack("3i", conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+    return uid
+
+
+@profiled("agent")
+def agent_request(request):
+    import socket
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+
+    path = agent_socket_path()
+    try:
+        folder_stat = os.stat(os.path.dirname(path))
+        if folder_stat.st_uid != os.getuid() or folder_stat.st_mode & 0o077:
+            return None
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.settimeout(5)
+            conn.connect(path)
+            if peer_uid(conn) != os.getuid():
+                return None
+
+            conn.sendall(json.dumps(request).encode("utf8") + b"\n")
+            return json.loads(conn.makefile("rb").readline())
+    except (OSError, ValueError):
+        return None
+
+
+def agent_get(name):
+    reply = agent_request({"op": "get", "name": name})
+    if reply is None or reply.get("value") is None:
+        return None
+
+    return bytes.fromhex(reply["value"])
+
+
+def agent_put(name, value):
+    agent_request({"op": "put", "name": name, "value": value.hex()})
+
+
+def agent_master_name():
+    return f"{backend.name}/master/{'secret' if args.secret else 'default'}"
 
 
-def get_encrypted_by_key(storage_key, encryption_key):
+def run_agent(listener, path, timeout):
+    import socket
+    cache = {}
+    last_used = time.monotonic()
     try:
-        return get_encrypted(keyed_hash(storage_key, encryption_key), encryption_key)
+        while True:
+            remaining = last_used + timeout - time.monotonic()
+            if remaining <= 0:
+                break
+
+            listener.settimeout(remaining)
+            try:
+                conn, _ = listener.accept()
+            except socket.timeout:
+                continue
+
+            with conn:
+                try:
+                    if peer_uid(conn) != os.getuid():
+                        continue
+
+                    conn.settimeout(5)
+                    request = json.loads(conn.makefile("rb").readline(65536))
+                    op = request["op"]
+                    reply = {}
+                    if op == "get":
+                        value = cache.get(request["name"])
+                        reply["value"] = None if value is None else value.hex()
+                    elif op == "put":
+                        cache[request["name"]] = bytearray.fromhex(request["value"])
+                    elif op == "clear" or op == "stop":
+                        for value in cache.values():
+                            value[:] = bytes(len(value))
+
+                        cache.clear()
+
+                    conn.sendall(json.dumps(reply).encode("utf8") + b"\n")
+                except (OSError, ValueError, KeyError, TypeError, AttributeError):
+                    continue
+
+            last_used = time.monotonic()
+            if op == "stop":
+                break
+    finally:
+        for value in cache.values():
+            value[:] = bytes(len(value))
+
+        listener.close()
+        os.remove(path)
+
+
+def start_agent(timeout):
+    import socket
+    if not hasattr(socket, "AF_UNIX") or not hasattr(os, "fork"):
+        raise RuntimeError("The agent is not supported on this platform")
+
+    if agent_request({"op": "ping"}) is not None:
+        return False
+
+    path = agent_socket_path()
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    folder_stat = os.stat(os.path.dirname(path))
+    assert folder_stat.st_uid == os.getuid() and not folder_stat.st_mode & 0o077, f"insecure agent folder {os.path.dirname(path)}"
+    if os.path.exists(path):
+        os.remove(path)  # left by an agent that was killed
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(old_umask)
+
+    listener.listen()
+    if os.fork() != 0:
+        listener.close()
+        return True
+
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in range(3):
+        os.dup2(devnull, fd)
+
+    try:
+        run_agent(listener, path, timeout)
+    finally:
+        os._exit(0)
+
+
+def lookup_cache_name(key: str, master_key, params):
+    # the agent caches the scrypt results under names that do not reveal the keys
+    return "lookup/" + keyed_hash(encode_kdf_params(params) + key.encode("utf8"), master_key)
+
+
+def derive_lookup_key(key: str, master_key, salt, params):
+    cache_name = lookup_cache_name(key, master_key, params)
+    key_derived = agent_get(cache_name)
+    if key_derived is None:
+        key_derived = key_from_password(key, salt, params)
+        agent_put(cache_name, key_derived)
+
+    return key_derived
+
+
+def read_kdf_versions(master_key):
+    # all the scrypt parameters this storage has used, the current ones last
+    try:
+        record = get_encrypted_by_key(b"kdf", master_key)
+    except:
+        return [dict(kdf_params)]
+
+    return [decode_kdf_params(record[i:i + 3]) for i in range(0, len(record), 3)]
+
+
+def write_kdf_versions(versions, master_key):
+    store_encrypted_by_key(b"kdf", b"".join(map(encode_kdf_params, versions)), master_key)
+
+
+def erase_entry(storage_key, encryption_key):
+    # overwritten with noise rather than deleted, so that it stays a decoy
+    store_padded(keyed_hash(storage_key, encryption_key), secrets.token_bytes(storage_bytes))
+
+
+def storage_salt(master_key, vault):
+    return bytes.fromhex(vault["salt"]) if vault is not None else get_encrypted_by_key(b"salt", master_key)
+
+
+def find_password(key: str, master_key, vault, salt, versions, outside_vault=True):
+    # returns (password, version, derived key, whether it is in the vault), trying the current parameters first
+    for version in reversed(range(len(versions))):
+        key_derived = derive_lookup_key(key, master_key, salt, versions[version])
+        if vault is not None and key_derived.hex() in vault["entries"]:
+            return vault["entries"][key_derived.hex()], version, key_derived, True
+
+        if vault is None or outside_vault:
+            try:
+                return get_encrypted_by_key(key_derived, master_key).decode("utf8"), version, key_derived, False
+            except:
+                pass
+
+    return None
+
+
+def find_passwords(keys, master_key, vault, salt, versions, outside_vault=True):
+    # find_password for many keys, deriving each version in parallel. Returns (version, derived key, whether it is in the vault)
+    # or None for each key, and the keys derived with the current parameters
+    found = [None] * len(keys)
+    current = []
+    for version in reversed(range(len(versions))):
+        remaining = [i for i in range(len(keys)) if found[i] is None]
+        if len(remaining) == 0:
+            break
+
+        derived = derive_lookup_keys([keys[i] for i in remaining], master_key, salt, versions[version])
+        if version == len(versions) - 1:
+            current = derived
+
+        for i, key_derived in zip(remaining, derived):
+            if vault is not None and key_derived.hex() in vault["entries"]:
+                found[i] = version, key_derived, True
+            elif vault is None or outside_vault:
+                try:
+                    get_encrypted_by_key(key_derived, master_key)
+                    found[i] = version, key_derived, False
+                except:
+                    pass
+
+    return found, current
+
+
+def remove_password(master_key, vault, key_derived, in_vault):
+    if in_vault:
+        del vault["entries"][key_derived.hex()]
+    else:
+        erase_entry(key_derived, master_key)
+
+
+def store_encrypted_by_key(storage_key, data_to_store, encryption_key, size_bytes=storage_bytes):
+    store_encrypted(keyed_hash(storage_key, encryption_key), data_to_store, encryption_key, size_bytes)
+
+
+def get_encrypted_by_key(storage_key, encryption_key, size_bytes=storage_bytes):
+    try:
+        return get_encrypted(keyed_hash(storage_key, encryption_key), encryption_key, size_bytes)
     except:
         raise RuntimeError("Storage is damaged")
 
 
+def derivation_jobs(params):
+    # scrypt needs about 128 * r * n bytes, so the number of parallel derivations is bounded by the free memory
+    try:
+        free_memory = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return 1
+
+    return max(1, min(os.cpu_count() or 1, free_memory // (kdf_memory(params) + 2 ** 27)))
+
+
+def derive_lookup_keys(keys, master_key, salt, params):
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from tqdm import tqdm
+    cache_names = [lookup_cache_name(key, master_key, params) for key in keys]
+    derived = [agent_get(cache_name) for cache_name in cache_names]
+    missing = [i for i, key_derived in enumerate(derived) if key_derived is None]
+    if len(missing) == 0:
+        return derived
+
+    num_jobs = min(args.jobs or derivation_jobs(params), len(missing))
+    if num_jobs > 1 and "fork" in multiprocessing.get_all_start_methods():
+        pool = ProcessPoolExecutor(num_jobs, mp_context=multiprocessing.get_context("fork"))
+        results = pool.map(functools.partial(timed_key_from_password, salt=salt, params=params), [keys[i] for i in missing])
+    else:
+        pool = None
+        results = ((key_from_password(keys[i], salt, params), None) for i in missing)
+
+    try:
+        for (key_derived, seconds), i in zip(tqdm(results, total=len(missing), desc="deriving lookup keys"), missing):
+            if seconds is not None:
+                add_to_profile("scrypt", seconds)
+
+            derived[i] = key_derived
+            agent_put(cache_names[i], key_derived)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    return derived
+
+
+def add_decoys(num_decoys, size_bytes):
+    from tqdm import trange
+    random_keys = []
+    for _ in trange(num_decoys):
+        rnd_key = secrets.token_hex(64)
+        backend.set(rnd_key, secrets.token_hex(size_bytes))
+        random_keys.append(rnd_key)
+
+    add_keys_to_index(random_keys)
+
+
+def read_vault(master_key):
+    # returns the vault of a storage in the vault layout, or None for a storage in the entry-per-password layout
+    try:
+        first_shard = get_encrypted_by_key(b"vault#0", master_key, vault_shard_bytes)
+    except:
+        return None, []
+
+    num_shards = int.from_bytes(first_shard[:4], byteorder="little")
+    chunks = [first_shard[4:]]
+    for i in range(1, num_shards):
+        chunks.append(get_encrypted_by_key(f"vault#{i}".encode("utf8"), master_key, vault_shard_bytes))
+
+    return json.loads(b"".join(chunks).decode("utf8")), chunks
+
+
+def write_vault(vault, master_key, old_chunks=()):
+    # the vault is split into shards of equal size, which look like the decoys. Only the changed shards are written
+    payload = json.dumps(vault, sort_keys=True).encode("utf8")
+    capacity = vault_shard_bytes - 36
+    chunks = [payload[:capacity - 4]] + [payload[i:i + capacity] for i in range(capacity - 4, len(payload), capacity)]
+    for i, chunk in enumerate(chunks):
+        if i < len(old_chunks) and chunk == old_chunks[i] and (i > 0 or len(chunks) == len(old_chunks)):
+            continue
+
+        if i == 0:
+            chunk = len(chunks).to_bytes(4, byteorder="little") + chunk
+
+        store_encrypted_by_key(f"vault#{i}".encode("utf8"), chunk, master_key, vault_shard_bytes)
+
+
+def convert_to_vault(master_key):
+    salt = get_encrypted_by_key(b"salt", master_key)
+    vault = {"salt": salt.hex(), "entries": {}, "visible": []}
+    num_visible_keys = int.from_bytes(get_encrypted_by_key(b"num_visible_keys", master_key), byteorder="little")
+    keys = []
+    for i in range(num_visible_keys):
+        try:
+            keys.append(get_encrypted_by_key(f"key#{i}".encode("utf8"), master_key).decode("utf8"))
+        except:
+            print("Warning: could not read a visible key")
+
+    versions = read_kdf_versions(master_key)
+    for key, key_derived in zip(keys, derive_lookup_keys(keys, master_key, salt, versions[-1])):
+        try:
+            password = get_encrypted_by_key(key_derived, master_key).decode("utf8")
+        except:  # stored with older parameters
+            found = find_password(key, master_key, None, salt, versions)
+            if found is None:
+                print(f"Warning: could not move the password for {key}")
+                continue
+
+            password = found[0]
+
+        vault["entries"][key_derived.hex()] = password
+        vault["visible"].append(key)
+
+    write_vault(vault, master_key)
+    store_encrypted_by_key(b"num_visible_keys", (0).to_bytes(4, byteorder="little"), master_key)
+    add_decoys(1 + secrets.randbelow(3), vault_shard_bytes)
+
+
 def init_storage(storage_key):
     master_key = random_key()
     store_encrypted_by_key(b"master_key", master_key, storage_key)
@@ -188,15 +972,25 @@ def init_storage(storage_key):
 
 
 def add_password(key: str, password: str, master_key, visible):
-    salt = get_encrypted_by_key(b"salt", master_key)
-    key_derived = key_from_password(key, salt)
-    already_present = False
-    try:
-        get_encrypted_by_key(key_derived, master_key)
-        already_present = True
+    vault, chunks = read_vault(master_key)
+    salt = storage_salt(master_key, vault)
+    versions = read_kdf_versions(master_key)
+    found = find_password(key, master_key, vault, salt, versions, outside_vault=False)
+    already_present = found is not None
+    if already_present:
         print("A password is already present for this key. Replacing it")
-    except:
-        pass
+        _, version, old_key_derived, in_vault = found
+        if version != len(versions) - 1:
+            remove_password(master_key, vault, old_key_derived, in_vault)
+
+    key_derived = derive_lookup_key(key, master_key, salt, versions[-1])
+    if vault is not None:
+        vault["entries"][key_derived.hex()] = password
+        if visible and not already_present:
+            vault["visible"].append(key)
+
+        write_vault(vault, master_key, chunks)
+        return
 
     store_encrypted_by_key(key_derived, password.encode("utf8"), master_key)
     if visible and not already_present:
@@ -205,8 +999,79 @@ def add_password(key: str, password: str, master_key, visible):
         store_encrypted_by_key(b"num_visible_keys", (num_visible_keys + 1).to_bytes(4, byteorder="little"), master_key)
 
 
+def import_passwords(entries, master_key, visible):
+    from tqdm import tqdm
+    global index_batch
+    entries = list(dict(entries).items())  # a key given twice is stored once, with its last password
+    vault, chunks = read_vault(master_key)
+    salt = storage_salt(master_key, vault)
+    versions = read_kdf_versions(master_key)
+    found, derived = find_passwords([key for key, _ in entries], master_key, vault, salt, versions, outside_vault=False)
+    if vault is not None:
+        for (key, password), key_derived, key_found in zip(entries, derived, found):
+            if key_found is not None and key_found[0] != len(versions) - 1:  # stored with older parameters
+                remove_password(master_key, vault, key_found[1], key_found[2])
+
+            vault["entries"][key_derived.hex()] = password
+            if visible and key_found is None:
+                vault["visible"].append(key)
+
+        write_vault(vault, master_key, chunks)
+        return
+
+    index_batch = []
+    try:
+        num_visible_keys = int.from_bytes(get_encrypted_by_key(b"num_visible_keys", master_key), byteorder="little")
+        for (key, password), key_derived, key_found in zip(tqdm(entries, desc="storing"), derived, found):
+            if key_found is not None and key_found[0] != len(versions) - 1:
+                remove_password(master_key, vault, key_found[1], key_found[2])
+
+            store_encrypted_by_key(key_derived, password.encode("utf8"), master_key)
+            if visible and key_found is None:
+                store_encrypted_by_key(f"key#{num_visible_keys}".encode("utf8"), key.encode("utf8"), master_key)
+                num_visible_keys += 1
+
+        store_encrypted_by_key(b"num_visible_keys", num_visible_keys.to_bytes(4, byteorder="little"), master_key)
+    finally:
+        new_keys = index_batch
+        index_batch = None
+        add_keys_to_index(new_keys)
+
+
+def parse_import(text, format):
+    import csv
+    if format == "auto":
+        format = "json" if text.lstrip()[:1] in ("[", "{") else "csv"
+
+    if format == "json":
+        data = json.loads(text)
+        if isinstance(data, dict):
+            entries = list(data.items())
+        else:
+            entries = [(entry["key"], entry["password"]) for entry in data]
+    else:
+        rows = [row for row in csv.reader(io.StringIO(text)) if len(row) > 0]
+        if len(rows) > 0 and [column.strip().lower() for column in rows[0]] == ["key", "password"]:
+            rows = rows[1:]
+
+        assert all(len(row) == 2 for row in rows), "each CSV row should have two columns: key and password"
+        entries = [tuple(row) for row in rows]
+
+    assert all(isinstance(key, str) and isinstance(password, str) and key and password for key, password in entries), \
+        "keys and passwords should be non-empty strings"
+
+    return entries
+
+
 def list_keys(master_key):
     print("Visible keys in this storage:")
+    vault, _ = read_vault(master_key)
+    if vault is not None:
+        for key in vault["visible"]:
+            print(key)
+
+        return
+
     num_visible_keys = int.from_bytes(get_encrypted_by_key(b"num_visible_keys", master_key), byteorder="little")
     for i in range(num_visible_keys):
         try:
@@ -217,15 +1082,190 @@ def list_keys(master_key):
 
 
 def get_password(key: str, master_key):
-    salt = get_encrypted_by_key(b"salt", master_key)
-    key_derived = key_from_password(key, salt)
+    # hidden keys stored before the storage was converted to the vault stay outside of the vault
+    vault, chunks = read_vault(master_key)
+    salt = storage_salt(master_key, vault)
+    versions = read_kdf_versions(master_key)
+    found = find_password(key, master_key, vault, salt, versions)
+    if found is None:
+        raise RuntimeError("Password for this key not found")
+
+    password, version, key_derived, in_vault = found
+    if version != len(versions) - 1:  # stored with older parameters, moved under the current ones
+        remove_password(master_key, vault, key_derived, in_vault)
+        key_derived = derive_lookup_key(key, master_key, salt, versions[-1])
+        if vault is not None:
+            vault["entries"][key_derived.hex()] = password
+            write_vault(vault, master_key, chunks)
+        else:
+            store_encrypted_by_key(key_derived, password.encode("utf8"), master_key)
+
+    return password
+
+
+def run_bounded(fn, items, num_threads):
+    # yields (item, future) in the order of items, keeping only a few tasks per thread in flight
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(num_threads) as pool:
+        pending = deque()
+        for item in items:
+            pending.append((item, pool.submit(fn, item)))
+            if len(pending) >= num_threads * 4:
+                yield pending.popleft()
+
+        while pending:
+            yield pending.popleft()
+
+
+@profiled("encrypt")
+def write_backup_chunk(f, key, file_header, counter, data: bytes, final):
+    # the file header, the chunk number and the final flag are authenticated, so that changed parameters and reordered, dropped or
+    # appended chunks are detected
+    from Crypto.Cipher import AES
+    cipher = AES.new(key, AES.MODE_EAX)
+    cipher.update(file_header + counter.to_bytes(8, byteorder="little") + bytes([final]))
+    ciphertext, tag = cipher.encrypt_and_digest(data)
+    f.write(len(ciphertext).to_bytes(4, byteorder="little") + bytes([final]) + cipher.nonce + tag + ciphertext)
+
+
+@profiled("decrypt")
+def decrypt_backup_chunk(key, nonce, tag, ciphertext, associated_data):
+    from Crypto.Cipher import AES
+    cipher = AES.new(key, AES.MODE_EAX, nonce)
+    cipher.update(associated_data)
     try:
-        return get_encrypted_by_key(key_derived, master_key).decode("utf8")
+        return cipher.decrypt_and_verify(ciphertext, tag)
+    except ValueError:
+        raise RuntimeError("Wrong password or damaged backup file")
+
+
+def read_backup_chunks(f, key, file_header):
+    counter = 0
+    while True:
+        header = f.read(37)
+        if len(header) < 37:
+            raise RuntimeError("Backup file is truncated")
+
+        length = int.from_bytes(header[:4], byteorder="little")
+        final = header[4]
+        ciphertext = f.read(length)
+        if len(ciphertext) < length:
+            raise RuntimeError("Backup file is truncated")
+
+        yield decrypt_backup_chunk(key, header[5:21], header[21:37], ciphertext, file_header + counter.to_bytes(8, byteorder="little") + bytes([final]))
+
+        if final:
+            if f.read(1):
+                raise RuntimeError("Backup file has unexpected data at the end")
+
+            return
+
+        counter += 1
+
+
+def default_kdf_params():
+    # the current parameters of the default storage
+    try:
+        default_key = get_encrypted_by_key(b"master_key", default_storage_key)
     except:
-        raise RuntimeError("Password for this key not found")
+        return dict(kdf_params)
+
+    return read_kdf_versions(default_key)[-1]
+
+
+def backup(filename, password):
+    from tqdm import tqdm
+    salt = secrets.token_bytes(16)
+    params = default_kdf_params()
+    encryption_key = key_from_password(password, salt, params)
+    file_header = backup_magic + salt + encode_kdf_params(params)
+    num_failed = 0
+    with open(filename, "wb") as f:
+        f.write(file_header)
+        counter = 0
+        chunk = []
+        chunk_len = 0
+        entries = run_bounded(lambda key: backend.get(key), iter_index(args.jobs), args.jobs)
+        for key, future in tqdm(entries, desc="saving storage"):
+            try:
+                value = future.result()
+                assert value is not None
+            except Exception as e:
+                print(f"Warning: could not retrieve entry {key[:8]}...: {e or 'not found'}")
+                num_failed += 1
+                continue
+
+            entry = f"{key}\t{value}\n".encode("utf8")
+            chunk.append(entry)
+            chunk_len += len(entry)
+            if chunk_len >= backup_chunk_bytes:
+                write_backup_chunk(f, encryption_key, file_header, counter, b"".join(chunk), False)
+                counter += 1
+                chunk = []
+                chunk_len = 0
+
+        write_backup_chunk(f, encryption_key, file_header, counter, b"".join(chunk), True)
+
+    if num_failed > 0:
+        print(f"Warning: {num_failed} entries could not be saved")
+
+
+def read_backup_entries(f, encryption_key, file_header):
+    for chunk in read_backup_chunks(f, encryption_key, file_header):
+        for line in chunk.decode("utf8").splitlines():
+            yield line.split("\t")
+
+
+def restore(filename, password):
+    from tqdm import tqdm
+    with open(filename, "rb") as f:
+        magic = f.read(len(backup_magic))
+        if magic == backup_magic:
+            salt = f.read(16)
+            params = f.read(3)
+            encryption_key = key_from_password(password, salt, decode_kdf_params(params))
+            entries = read_backup_entries(f, encryption_key, magic + salt + params)
+        else:  # a backup in the format without chunks
+            f.seek(0)
+            salt = f.read(16)
+            encryption_key = key_from_password(password, salt)
+            data = decrypt(f.read(), encryption_key).decode("utf8")
+            entries = (kv.split("\t") for kv in data.split("\n"))
+
+        restored_keys = []
+        num_failed = 0
+        completed = False
+        try:
+            set_entry = lambda entry: backend.set(entry[0], entry[1])
+            for (key, value), future in tqdm(run_bounded(set_entry, entries, args.jobs), desc="restoring backup"):
+                try:
+                    future.result()
+                    restored_keys.append(key)
+                except Exception as e:
+                    print(f"Warning: could not restore entry {key[:8]}...: {e}")
+                    num_failed += 1
+
+            completed = True
+        finally:
+            if completed:
+                replace_index(restored_keys, args.jobs)
+            else:  # the current storage stays indexed too
+                add_keys_to_index(restored_keys)
+
+            print(f"{len(restored_keys)} entries restored")
+            if num_failed > 0:
+                print(f"Warning: {num_failed} entries could not be restored")
 
 
-def retrieve_master_key(read_only=False):
+def retrieve_master_key(read_only=False, use_agent=True):
+    if use_agent:
+        master_key = agent_get(agent_master_name())
+        if master_key is not None:
+            if not args.secret:
+                print("Using default, not password protected storage. The passwords are visible to other programs ran by user")
+
+            return master_key
+
     try:
         default_key = get_encrypted_by_key(b"master_key", default_storage_key)
     except:
@@ -235,14 +1275,8 @@ def retrieve_master_key(read_only=False):
         print("Initializing storage for first use")
         init_storage(default_storage_key)
         default_key = get_encrypted_by_key(b"master_key", default_storage_key)
-        num_random_pairs = 30 + secrets.randbelow(30)
-        random_keys = []
-        for _ in trange(num_random_pairs):
-            rnd_key = secrets.token_hex(64)
-            keyring.set_password(tag1, rnd_key, secrets.token_hex(storage_bytes))
-            random_keys.append(rnd_key)
-
-        add_keys_to_index(random_keys)
+        add_decoys(30 + secrets.randbelow(30), storage_bytes)
+        add_decoys(2 + secrets.randbelow(4), vault_shard_bytes)
 
     if not args.secret:
         print("Using default, not password protected storage. The passwords are visible to other programs ran by user")
@@ -250,10 +1284,22 @@ def retrieve_master_key(read_only=False):
 
     storage_password = getpass.getpass("Enter storage password: ")
     salt = get_encrypted_by_key(b"salt", default_key)
-    storage_key = key_from_password(storage_password, salt)
+    versions = read_kdf_versions(default_key)
+    storage_key = key_from_password(storage_password, salt, versions[-1])
     try:
         return get_encrypted_by_key(b"master_key", storage_key)
     except:
+        for params in reversed(versions[:-1]):  # the storage could be created before the last calibration
+            old_storage_key = key_from_password(storage_password, salt, params)
+            try:
+                master_key = get_encrypted_by_key(b"master_key", old_storage_key)
+            except:
+                continue
+
+            store_encrypted_by_key(b"master_key", master_key, storage_key)
+            erase_entry(b"master_key", old_storage_key)
+            return master_key
+
         if read_only:
             raise RuntimeError("Secret storage with this password was not found")
 
@@ -270,89 +1316,113 @@ def retrieve_master_key(read_only=False):
         return get_encrypted_by_key(b"master_key", storage_key)
     
 
-try:
-    if args.command == "gen":
-        output(gen_password())
-    elif args.command == "store":
-        master_key = retrieve_master_key()
-        if args.input:
-            password = getpass.getpass("Enter password to store for the given key: ")
-        else:
-            password = gen_password()
-            print("Random password was generated")
+def main(argv=None):
+    global args, backend, profile, profile_lock
+    start_time = time.perf_counter()
+    argv = sys.argv[1:] if argv is None else argv
+    parser = build_parser(argv)
+    args = parser.parse_args(argv)
+    if args.profile:
+        import threading
+        profile = {}
+        profile_lock = threading.Lock()
 
-        add_password(args.key, password, master_key, not args.hidden)
-        print("Password stored")
-        if args.output and not args.input:
+    if args.backend == "sqlite":
+        backend = SqliteBackend(args.db)
+
+    try:
+        if args.command == "gen":
+            assert args.count >= 1, "wrong number of passwords selected"
+            passwords, entropy = gen_passwords(args.count)
+            output("\n".join(passwords))
+            print(f"Entropy: {entropy:.1f} bits per password", file=sys.stderr)
+        elif args.command == "store":
+            master_key = retrieve_master_key()
+            if args.input:
+                password = getpass.getpass("Enter password to store for the given key: ")
+            else:
+                password = gen_password()
+                print("Random password was generated")
+
+            add_password(args.key, password, master_key, not args.hidden)
+            print("Password stored")
+            if args.output and not args.input:
+                output(password)
+        elif args.command == "get":
+            master_key = retrieve_master_key(read_only=True)
+            password = get_password(args.key, master_key)
             output(password)
-    elif args.command == "get":
-        master_key = retrieve_master_key(read_only=True)
-        password = get_password(args.key, master_key)
-        output(password)
-    elif args.command == "list":
-        master_key = retrieve_master_key(read_only=True)
-        list_keys(master_key)
-    elif args.command == "nuke":
-        code = ''.join(secrets.choice(string.ascii_letters) for _ in range(6))
-        print(f"This will delete all storages (default and secret). Recovery will not be possible. Enter the code {' '.join(list(code))} (without spaces) to confirm")
-        confirmation = input("Nuclear code: ")
-        assert confirmation == code, "Nuclear strike not confirmed"
-        print("Nuclear strike confirmed")
-        init_storage(default_storage_key)
-        print("Storages erased")
-    elif args.command == "backup":
-        password = getpass.getpass("Create a password for the backup: ")
-        password_confirmation = getpass.getpass("Confirm the password for the backup: ")
-        assert password == password_confirmation, "Backup password not confirmed"
-
-        filename = args.file
-        with open(filename, "wb") as f:
-            try:
-                stored_keys = keyring.get_password(tag1, tag2)
-                assert stored_keys is not None
-            except:
-                raise RuntimeError("Storage not initialized")
+        elif args.command == "list":
+            master_key = retrieve_master_key(read_only=True)
+            list_keys(master_key)
+        elif args.command == "nuke":
+            code = ''.join(secrets.choice(string.ascii_letters) for _ in range(6))
+            print(f"This will delete all storages (default and secret). Recovery will not be possible. Enter the code {' '.join(list(code))} (without spaces) to confirm")
+            confirmation = input("Nuclear code: ")
+            assert confirmation == code, "Nuclear strike not confirmed"
+            print("Nuclear strike confirmed")
+            init_storage(default_storage_key)
+            agent_request({"op": "clear"})
+            print("Storages erased")
+        elif args.command == "backup":
+            password = getpass.getpass("Create a password for the backup: ")
+            password_confirmation = getpass.getpass("Confirm the password for the backup: ")
+            assert password == password_confirmation, "Backup password not confirmed"
+
+            backup(args.file, password)
+        elif args.command == "restore":
+            print("Restoring a backup will delete the current storage. Recovery will not be possible. Type 'Yes.' without quotes to continue")
+            confirmation = input("Confirm restore? ")
+            assert confirmation == "Yes.", "Restore is not confirmed"
+            password = getpass.getpass("Enter the backup file password: ")
+            restore(args.file, password)
+            agent_request({"op": "clear"})
+        elif args.command == "import":
+            entries = parse_import(sys.stdin.read(), args.format)
+            master_key = retrieve_master_key(read_only=args.secret)
+            import_passwords(entries, master_key, not args.hidden)
+            print(f"{len(entries)} passwords imported")
+        elif args.command == "calibrate":
+            master_key = retrieve_master_key()
+            params, elapsed = calibrate_kdf(args.target_ms / 1000, args.max_memory_mb * 2 ** 20)
+            print(f"Selected scrypt parameters n=2^{params['n'].bit_length() - 1}, r={params['r']}, p={params['p']}: "
+                  f"{elapsed * 1000:.0f} ms and {kdf_memory(params) / 2 ** 20:.0f} MB per key derivation")
+
+            versions = read_kdf_versions(master_key)
+            if versions[-1] == params:
+                print("The storage already uses these parameters")
+            else:
+                write_kdf_versions([version for version in versions if version != params] + [params], master_key)
+                print("Parameters saved. Existing entries are migrated when they are accessed")
+        elif args.command == "unlock":
+            master_key = retrieve_master_key(read_only=True, use_agent=False)
+            if start_agent(args.timeout * 60):
+                print(f"Agent started. It forgets the keys after {args.timeout:g} minutes of inactivity, or on 'lock' command")
+
+            agent_put(agent_master_name(), master_key)
+            print("Storage unlocked")
+        elif args.command == "vault":
+            master_key = retrieve_master_key()
+            if read_vault(master_key)[0] is not None:
+                print("This storage already uses the vault layout")
+            else:
+                convert_to_vault(master_key)
+                print("Storage converted to the vault layout")
+        elif args.command == "lock":
+            if agent_request({"op": "stop"}) is None:
+                print("No agent is running")
+            else:
+                print("Agent stopped, the keys are forgotten")
+        else:
+            parser.print_help()
 
-            assert len(stored_keys) % 128 == 0, "Storage is damaged"
-            existing_keys_list = [stored_keys[i:i + 128] for i in range(0, len(stored_keys), 128)]
-            data = {}
-            for key in tqdm(existing_keys_list, desc="retrieving storage"):
-                try:
-                    data[key] = keyring.get_password(tag1, key)
-                except:
-                    print("Warning: could not retrieve a part of stored data")
-            
-            data = "\n".join(f"{key}\t{value}" for key, value in data.items())
-            salt = secrets.token_bytes(16)
-            encryption_key = key_from_password(password, salt)
-            encrypted_data = encrypt(data.encode("utf8"), encryption_key)
-            f.write(salt)
-            f.write(encrypted_data)
-    elif args.command == "restore":
-        print("Restoring a backup will delete the current storage. Recovery will not be possible. Type 'Yes.' without quotes to continue")
-        confirmation = input("Confirm restore? ")
-        assert confirmation == "Yes.", "Restore is not confirmed"
-        with open(args.file, "rb") as f:
-            salt = f.read(16)
-            encrypted_data = f.read()
+    except Exception as e:
+        print(f"Error: {e}")
+        exit(1)
+    finally:
+        if profile is not None:
+            print_profile(args.command, time.perf_counter() - start_time, args.profile_format)
 
-        password = getpass.getpass("Enter the backup file password: ")
-        encryption_key = key_from_password(password, salt)
-        data = decrypt(encrypted_data, encryption_key).decode("utf8")
-        data = dict(kv.split("\t") for kv in data.split("\n"))
-        for key, value in tqdm(data.items(), total=len(data), desc="restoring backup"):
-            keyring.set_password(tag1, key, value)
 
-        keyring.set_password(tag1, tag2, "")
-        add_keys_to_index(data.keys())
-    else:
-        parser.print_help()
-
-except xerox.base.XclipNotFound:
-    print("Please install xclip")
-    exit(1)
-except Exception as e:
-    print(f"Error: {e}")
-    exit(1)
-finally:
-    pass
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,90 @@
+from collections import deque
 from fractions import Fraction
+from decimal import Decimal
+import argparse
+import decimal
+import fileinput
+import functools
+import json
 import math
+import multiprocessing
+import os
+import re
+import sys
+import time
 
 
 def rational_factorial(x):
     if x.denominator != 1:
         raise RuntimeError(f"Trying to take factorial of a non-integer {x.numerator}/{x.denominator}")
 
+    if x < 0:
+        raise RuntimeError("Trying to take factorial of a negative number")
+
     return Fraction(math.factorial(x.numerator))
 
 
+def product(low, high):
+    # the product of the integers from low to high - 1 by binary splitting: the halves are multiplied at similar sizes, which is much
+    # faster for big numbers than multiplying by one factor at a time
+    if high - low <= 16:
+        return math.prod(range(low, high))
+
+    middle = (low + high) // 2
+    return product(low, middle) * product(middle, high)
+
+
+def integer_factorial_ratio(n, k):
+    # n! / k! for n >= k, with only the factors that do not cancel multiplied. When k! is small, the division by it is cheap and the C
+    # factorial is faster
+    if factorial_ratio_bits(k, 0) <= 4096:
+        return math.factorial(n) // math.factorial(k)
+
+    return product(k + 1, n + 1)
+
+
+def factorial_ratio(x, y):
+    # x! / y! for the programs "n ! k ! /"
+    n, k = x.numerator, y.numerator
+    if n >= k:
+        return Fraction(integer_factorial_ratio(n, k))
+
+    return Fraction(1, integer_factorial_ratio(k, n))
+
+
+def is_power_of_two(m):
+    return m > 0 and m & (m - 1) == 0
+
+
 def rational_power(x, y):
     if y.denominator != 1:
         raise RuntimeError(f"Non-integer power not supported: {y.numerator}/{y.denominator}")
 
-    return x ** y.numerator
+    if x == 0 and y < 0:
+        raise RuntimeError("Division by zero")
+
+    p, q, k = abs(x.numerator), x.denominator, y.numerator
+    if (q == 1 and is_power_of_two(p)) or (p == 1 and is_power_of_two(q)):
+        # a power of a power of two is a shift
+        shift = (p.bit_length() - q.bit_length()) * k
+        sign = -1 if x < 0 and k % 2 else 1
+        return Fraction(sign << shift) if shift >= 0 else Fraction(sign, 1 << -shift)
+
+    return x ** k
 
 
+def rational_division(x, y):
+    if y == 0:
+        raise RuntimeError("Division by zero")
+
+    return x / y
+
 
 binary_ops = {
     "+": lambda x, y: x + y,
     "-": lambda x, y: x - y,
     "*": lambda x, y: x * y,
-    "/": lambda x, y: x / y,
+    "/": rational_division,
     "^": rational_power,
 }
 
@@ -29,6 +92,12 @@ unary_ops = {
     "!": rational_factorial
 }
 
+token_regex = re.compile(r"(?P<number>[0-9]+(?:\.[0-9]*)?|\.[0-9]+)|(?P<operation>[" + re.escape("".join(binary_ops) + "".join(unary_ops)) + r"])|\s+")
+
+# instruction codes of compiled programs. Each instruction is a tuple (code, argument, position in the text), and its code is also the
+# number of values the instruction takes from the stack
+PUSH, UNARY, BINARY = range(3)
+
 
 def error_at(text, pos, message):
     msg_text = message + "\n" + text[:pos] + " HERE >>>" + text[pos:]
@@ -37,91 +106,373 @@ def error_at(text, pos, message):
 
 def parse(text: str):
     lexems = []
-    current_lexem = ""
-    lexem_start = 0
-    for i, c in enumerate(text):
-        if c.isspace():
-            if current_lexem != "":
-                lexems.append((current_lexem, lexem_start))
-                current_lexem = ""
-            
-            continue
+    pos = 0
+    while pos < len(text):
+        match = token_regex.match(text, pos)
+        if match is None:
+            error_at(text, pos, "Unexpected decimal point:" if text[pos] == "." else "Unexpected character:")
+
+        number, operation = match.group("number", "operation")
+        if number is not None:
+            if text.startswith(".", match.end()):
+                error_at(text, match.end(), "Unexpected decimal point:")
+
+            lexems.append((Fraction(number), pos))
+        elif operation is not None:
+            lexems.append((operation, pos))
+
+        pos = match.end()
+
+    return lexems
+
+
+def apply(text, instruction, args):
+    code, operation, start = instruction
+    try:
+        return operation(*args)
+    except RuntimeError as e:
+        error_at(text, start, str(e))
+
+
+def size_of(x):
+    return x.numerator.bit_length() + x.denominator.bit_length()
 
-        if c in unary_ops or c in binary_ops:
-            if current_lexem != "":
-                lexems.append((current_lexem, lexem_start))
-            
-            lexems.append((c, i))
-            current_lexem = ""
+
+def factorial_ratio_bits(n, k):
+    # an upper bound of the size of n! / k! for n >= k. The float error of lgamma is covered by the margin
+    if n < 2 ** 50:
+        return int((math.lgamma(n + 1) - math.lgamma(k + 1)) / math.log(2)) + 64
+
+    return (n - k) * n.bit_length() + 1
+
+
+def constant_value(entry):
+    instructions = entry[0]
+    return instructions[0][1] if len(instructions) == 1 else None
+
+
+def estimate_bits(lexem, operands):
+    # an upper bound of the size of the result, from the sizes of the operands and the values of the constant ones. Operands that
+    # give errors get small estimates, so that the errors are reported rather than the size
+    sizes = [bits for _, bits, _ in operands]
+    values = [constant_value(entry) for entry in operands]
+    if lexem in ("+", "-"):
+        return sizes[0] + sizes[1] + 1
+
+    if lexem in ("*", "/"):
+        return sizes[0] + sizes[1]
+
+    if lexem == "^":
+        base, exponent = values
+        if exponent is None:
+            return math.inf  # an exponent that is not a constant is above inline_bits in size
+
+        if exponent.denominator != 1 or base is not None and base.denominator == 1 and abs(base.numerator) <= 1:
+            return sizes[0]
+
+        if base is not None:
+            return int(abs(exponent.numerator) * (math.log2(abs(base.numerator)) + math.log2(base.denominator))) + 64
+
+        return sizes[0] * abs(exponent.numerator)
+
+    n = values[0]
+    if n is None:
+        return math.inf
+
+    if n.denominator != 1 or n < 0:
+        return sizes[0]
+
+    return factorial_ratio_bits(n.numerator, 0)
+
+
+def fold(text, entry, inline_bits):
+    # evaluates an operation on constants if its result is small enough
+    instructions, bits, factorial_of = entry
+    if len(instructions) == 1 or bits > inline_bits or any(code != PUSH for code, _, _ in instructions[:-1]):
+        return entry
+
+    value = apply(text, instructions[-1], [argument for _, argument, _ in instructions[:-1]])
+    return [(PUSH, value, instructions[0][2])], size_of(value), None
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_program(text, inline_bits, max_bits):
+    # turns the text into a flat tuple of instructions. Operations on constants are evaluated right away when their results are estimated
+    # to fit into inline_bits; the rest are left for execute. Programs whose results may be over max_bits are refused
+    stack = []  # for each value: (the instructions that compute it, an upper bound of its size in bits, n if the value is n! of a constant)
+    for lexem, start in parse(text):
+        if lexem in binary_ops:
+            operation, code = binary_ops[lexem], BINARY
+        elif lexem in unary_ops:
+            operation, code = unary_ops[lexem], UNARY
+        else:
+            stack.append(([(PUSH, lexem, start)], size_of(lexem), None))
             continue
 
-        if c == ".":
-            if current_lexem != "" and not current_lexem.isdigit():
-                raise error_at(text, i, "Unexpected decimal point:")
-        elif not c.isdigit():
-            raise error_at(text, i, "Unexpected character:")
-            
-        if current_lexem == "":
-            lexem_start = i
-
-        current_lexem += c
-
-    if current_lexem != "":
-        lexems.append((current_lexem, lexem_start))
-
-    processed_lexems = []
-    for lexem, start in lexems:
-        if lexem.isdigit():
-            processed_lexems.append((Fraction(lexem), start))
-        elif set(lexem).issubset(set("01234567890.")):
-            processed_lexems.append((Fraction(int(lexem.replace(".", "")), 10 ** len(lexem.split(".")[1])), start))
+        if len(stack) < code:
+            error_at(text, start, "Not enough arguments for operation:")
+
+        operands = stack[-code:]
+        del stack[-code:]
+        factorial_of = None
+        if lexem == "/" and operands[0][2] is not None and operands[1][2] is not None:
+            # the factorials are not computed: "n ! k ! /" becomes "n k factorial_ratio"
+            n, k = operands[0][2], operands[1][2]
+            operands = [(instructions[:1], size_of(instructions[0][1]), None) for instructions, _, _ in operands]
+            operation = factorial_ratio
+            bits = factorial_ratio_bits(max(n, k).numerator, min(n, k).numerator) + 1
         else:
-            processed_lexems.append((lexem, start))
+            operands = [fold(text, entry, inline_bits) for entry in operands]
+            bits = estimate_bits(lexem, operands)
+            if lexem == "!":
+                n = constant_value(operands[0])
+                if n is not None and n.denominator == 1 and n >= 0:
+                    factorial_of = n
 
-    return processed_lexems
+        if bits > max_bits:
+            size = f": up to {bits} bits" if bits != math.inf else ""
+            error_at(text, start, f"Result would be too large{size}, the limit is {max_bits} bits:")
 
+        entry = ([instruction for instructions, _, _ in operands for instruction in instructions] + [(code, operation, start)], bits, factorial_of)
+        # a factorial of a constant is computed only when it is used by something other than the division by another factorial
+        stack.append(entry if factorial_of is not None else fold(text, entry, inline_bits))
 
-print(f"Welcome to the reverse Polish notation calculator. Supported operations: {''.join(binary_ops)}{''.join(unary_ops)}\n"
-      "Integers and simple floating point numbers are supported.\n"
-      "All calculations are exact.\nCtrl-C or Ctrl-D to exit.")
+    return tuple(instruction for entry in stack for instruction in fold(text, entry, inline_bits)[0])
 
-try:
-    while True:
-        text = input("> ")
-        try:
-            stack = []
-            for lexem, start in parse(text):
-                if lexem in binary_ops:
-                    if len(stack) < 2:
-                        error_at(text, start, "Not enough arguments for operation:")
-
-                    arg2 = stack.pop()
-                    arg1 = stack.pop()
-                    try:
-                        stack.append(binary_ops[lexem](arg1, arg2))
-                    except RuntimeError as e:
-                        error_at(text, start, str(e))
-                elif lexem in unary_ops:
-                    if len(stack) < 1:
-                        error_at(text, start, "Not enough arguments for operation:")
-                    
-                    try:
-                        stack.append(unary_ops[lexem](stack.pop()))
-                    except RuntimeError as e:
-                        error_at(text, start, str(e))                        
-                else:
-                    stack.append(lexem)
 
-            for n in stack:
-                if n.denominator == 1:
-                    print(n.numerator)
+def execute(text, program):
+    stack = []
+    for instruction in program:
+        code, argument, _ = instruction
+        if code == PUSH:
+            stack.append(argument)
+        else:
+            args = stack[-code:]
+            del stack[-code:]
+            stack.append(apply(text, instruction, args))
+
+    return stack
+
+
+def evaluate(text, inline_bits, max_bits):
+    return execute(text, compile_program(text, inline_bits, max_bits))
+
+
+max_exact_digits = 1000  # results up to about this many digits are printed exactly even without --exact
+
+
+def allow_long_output():
+    if hasattr(sys, "set_int_max_str_digits"):  # Python 3.11+ limits the int to str conversion to 4300 digits by default
+        sys.set_int_max_str_digits(0)
+
+
+def approximate(m, digits):
+    # a positive integer as a Decimal with a few guard digits, computed from its top bits, in the context set by format_approximate
+    shift = max(0, m.bit_length() - 4 * digits - 64)
+    return Decimal(m >> shift) * Decimal(2) ** shift
+
+
+def digit_count(m, estimate):
+    # the exponent of the estimate gives the number of digits unless m is very close to a power of 10. Only then the exact check with a
+    # power of 10 is done, which is still much cheaper than the conversion to str
+    count = estimate.adjusted() + 1
+    leading = "".join(map(str, estimate.as_tuple().digits[:8]))
+    if leading == "99999999" or leading == "10000000":
+        if m >= 10 ** count:
+            count += 1
+        elif m < 10 ** (count - 1):
+            count -= 1
+
+    return count
+
+
+def format_approximate(n, digits):
+    with decimal.localcontext() as context:
+        context.prec = digits + 10
+        context.Emax = decimal.MAX_EMAX
+        context.Emin = decimal.MIN_EMIN
+        numerator = approximate(abs(n.numerator), digits)
+        denominator = approximate(n.denominator, digits)
+        value = numerator / denominator
+
+    sign = "-" if n < 0 else ""
+    mantissa, exponent = f"{value:.{digits - 1}e}".split("e")
+    size = f"{digit_count(abs(n.numerator), numerator)} digits"
+    if n.denominator != 1:
+        size = f"{digit_count(abs(n.numerator), numerator)}/{digit_count(n.denominator, denominator)} digits"
+
+    return f"~{sign}{mantissa}e{int(exponent):+d} ({size})"
+
+
+def format_number(n, digits=None):
+    # digits=None prints the exact value, otherwise the results larger than max_exact_digits are approximated to that many significant digits
+    exact_bits = max_exact_digits * 10 // 3
+    if digits is not None and (n.numerator.bit_length() > exact_bits or n.denominator.bit_length() > exact_bits):
+        return format_approximate(n, digits)
+
+    if n.denominator == 1:
+        return str(n.numerator)
+
+    return f"{n.numerator}/{n.denominator}"
+
+
+def evaluate_line(text, inline_bits, max_bits, digits):
+    # the outcome of one line as a part of its JSON record
+    try:
+        results = evaluate(text, inline_bits, max_bits)
+        for n in results:
+            bits = n.numerator.bit_length() + n.denominator.bit_length()
+            if bits > max_bits:
+                raise RuntimeError(f"Result is too large: {bits} bits, the limit is {max_bits}")
+
+        return {"results": [format_number(n, digits) for n in results]}
+    except (RuntimeError, ValueError) as e:  # ValueError: a number in the text is over the str to int conversion limit
+        return {"error": str(e)}
+
+
+def is_heavy(text, inline_bits, max_bits):
+    # the lines with operations left after compilation are evaluated in separate processes, which are stopped when they run out of time
+    try:
+        return any(code != PUSH for code, _, _ in compile_program(text, inline_bits, max_bits))
+    except (RuntimeError, ValueError):
+        return False  # the error is reported by evaluate_line
+
+
+def line_worker(connection, text, inline_bits, max_bits, digits):
+    if digits is None:
+        allow_long_output()
+
+    connection.send(evaluate_line(text, inline_bits, max_bits, digits))
+    connection.close()
+
+
+def start_worker(text, inline_bits, max_bits, digits):
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=line_worker, args=(sender, text, inline_bits, max_bits, digits), daemon=True)
+    process.start()
+    sender.close()
+    return process, receiver
+
+
+def wait_worker(process, connection, start_time, timeout):
+    try:
+        if connection.poll(max(0, start_time + timeout - time.monotonic())):
+            outcome = connection.recv()
+        else:
+            outcome = {"error": f"Time limit of {timeout} s exceeded"}
+            process.terminate()
+    except EOFError:
+        outcome = {"error": "Evaluation failed"}  # the worker died, for example, when it ran out of memory
+
+    process.join()
+    connection.close()
+    return outcome
+
+
+def finish(entry, timeout):
+    record, process, connection, start_time = entry
+    if process is not None:
+        record.update(wait_worker(process, connection, start_time, timeout))
+
+    print(json.dumps(record))
+
+
+def run_batch(files, jobs, timeout, inline_bits, max_bits, digits):
+    # records are printed in the input order, so the finished lines wait for the heavy ones before them
+    pending = deque()
+    running = 0
+    try:
+        with fileinput.input(files or ["-"]) as lines:
+            for line in lines:
+                text = line.rstrip("\n")
+                record = {"file": lines.filename(), "line": lines.filelineno()}
+                if is_heavy(text, inline_bits, max_bits):
+                    while running >= jobs:
+                        entry = pending.popleft()
+                        running -= entry[1] is not None
+                        finish(entry, timeout)
+
+                    pending.append((record, *start_worker(text, inline_bits, max_bits, digits), time.monotonic()))
+                    running += 1
                 else:
-                    print(f"{n.numerator}/{n.denominator}")
+                    record.update(evaluate_line(text, inline_bits, max_bits, digits))
+                    pending.append((record, None, None, None))
+
+                while pending and (pending[0][1] is None or pending[0][2].poll()) or len(pending) > 1000:
+                    entry = pending.popleft()
+                    running -= entry[1] is not None
+                    finish(entry, timeout)
+    finally:
+        # the records read before an error, such as a missing file, are still printed
+        while pending:
+            finish(pending.popleft(), timeout)
+
 
-        except RuntimeError as e:
+def interactive(timeout, inline_bits, max_bits, digits):
+    print(f"Welcome to the reverse Polish notation calculator. Supported operations: {''.join(binary_ops)}{''.join(unary_ops)}\n"
+          "Integers and simple floating point numbers are supported.\n"
+          "All calculations are exact.\nCtrl-C or Ctrl-D to exit.")
+
+    try:
+        while True:
+            text = input("> ")
+            if is_heavy(text, inline_bits, max_bits):
+                outcome = wait_worker(*start_worker(text, inline_bits, max_bits, digits), time.monotonic(), timeout)
+            else:
+                outcome = evaluate_line(text, inline_bits, max_bits, digits)
+
+            if "error" in outcome:
+                print(f"Error: {outcome['error']}")
+            else:
+                for result in outcome["results"]:
+                    print(result)
+
+    except EOFError:
+        print("Bye!")
+    except KeyboardInterrupt:
+        print("Bye!")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reverse Polish notation calculator with exact rational arithmetic")
+    parser.add_argument("--batch", action="store_true",
+                        help="evaluate the lines of the files (or stdin) and print a JSON record per line instead of the interactive mode")
+    parser.add_argument("files", metavar="FILE", nargs="*", help="input files for --batch, '-' for stdin (default)")
+    parser.add_argument("--jobs", metavar="N", type=int, default=os.cpu_count() or 1, help="processes for the lines with results over --inline-bits")
+    parser.add_argument("--timeout", metavar="SECONDS", type=float, default=10, help="time limit of a line with results over --inline-bits")
+    parser.add_argument("--digits", metavar="N", type=int, default=20,
+                        help=f"significant digits of the approximate output of results longer than {max_exact_digits} digits")
+    parser.add_argument("--exact", action="store_true", help="print all results exactly, however long")
+    parser.add_argument("--inline-bits", metavar="N", type=int, default=10 ** 6,
+                        help="operations whose results are estimated to be larger are evaluated in a separate process with the time limit")
+    parser.add_argument("--max-bits", metavar="N", type=int, default=10 ** 8,
+                        help="operations whose results are estimated to be larger are refused before evaluation")
+    args = parser.parse_args()
+    if args.files and not args.batch:
+        parser.error("input files require --batch")
+
+    if args.digits < 1:
+        parser.error("--digits must be positive")
+
+    if args.jobs < 1:
+        parser.error("--jobs must be positive")
+
+    if args.timeout <= 0:
+        parser.error("--timeout must be positive")
+
+    digits = None if args.exact else args.digits
+    if args.exact:
+        allow_long_output()
+
+    if args.batch:
+        try:
+            run_batch(args.files, args.jobs, args.timeout, args.inline_bits, args.max_bits, digits)
+        except OSError as e:
             print(f"Error: {e}")
-        
-except EOFError:
-    print("Bye!")
-except KeyboardInterrupt:
-    print("Bye!")
+            exit(1)
+    else:
+        interactive(args.timeout, args.inline_bits, args.max_bits, digits)
+
+
+if __name__ == "__main__":
+    main()